@@ -18,9 +18,13 @@ import proofmarshal.serialize
 
 @functools.total_ordering
 class Bits:
-    """Immutable array of bits"""
+    """Immutable array of bits
 
-    __slots__ = ['__length', '__buf']
+    Stored as an int, with the first bit as the most significant, so that
+    prefix operations are shifts, masks and XORs rather than loops.
+    """
+
+    __slots__ = ['__length', '__value']
 
     def __new__(cls, iterable=None):
         """Construct immutable array of bits from an iterable"""
@@ -30,7 +34,7 @@ class Bits:
             except AttributeError:
                 self = object().__new__(cls)
                 self.__length = 0
-                self.__buf = b''
+                self.__value = 0
                 cls.__empty_Bits_singleton = self
                 return self
 
@@ -38,108 +42,156 @@ class Bits:
             return iterable
 
         else:
-            buf = []
-            byte = 0
+            value = 0
             length = 0
             for bit in iterable:
-                bit = bool(bit)
-                byte |= bit << (7 - (length % 8))
-
+                value = (value << 1) | bool(bit)
                 length += 1
-                if length % 8 == 0:
-                    buf.append(byte)
-                    byte = 0
-            buf.append(byte)
 
             if length:
-                self = object().__new__(cls)
-                self.__length = length
-                self.__buf = bytes(buf)
-                return self
+                return cls.__from_int(value, length)
 
             else:
                 return Bits()
 
+    @classmethod
+    def __from_int(cls, value, length):
+        """Create bits from an int, without any checks"""
+        self = object().__new__(cls)
+        self.__length = length
+        self.__value = value
+        return self
+
     def __repr__(self):
         return '%s([%s])' % (self.__class__.__qualname__,
                              ",".join(['1' if bit else '0' for bit in self]))
 
     @classmethod
-    def from_bytes(cls, buf, length=None):
-        """Create bits from bytes
+    def from_int(cls, value, length):
+        """Create bits from an int
+
+        The first bit is the most significant of length bits.
+        """
+        if not isinstance(value, int):
+            raise TypeError('Expected int value; got %s' % value.__class__.__qualname__)
+        if length.__class__ is not int:
+            raise TypeError('Expected int length; got %s' % length.__class__.__qualname__)
+        if length < 0:
+            raise ValueError('Length must be non-negative int')
+        if not (0 <= value < (1 << length)):
+            raise ValueError('Value out of range for length')
+
+        return cls.__from_int(int(value), length) if length else Bits()
 
-        length - Length in bits (if not len(buf)*8)
+    @classmethod
+    def from_bytes(cls, buf, length=None, offset=0):
+        """Create bits from bytes
 
-        Note that internally the provided bytes will be reused; a new copy will
-        not be created.
+        length - Length in bits (if not len(buf)*8 - offset)
+        offset - Offset in bits of the first bit in buf
         """
         if buf.__class__ is not bytes:
             raise TypeError('Expected bytes instance; got %s' % buf.__class__.__qualname__)
 
+        if offset.__class__ is not int:
+            raise TypeError('Expected int offset; got %s' % offset.__class__.__qualname__)
+        if offset < 0:
+            raise ValueError('Offset must be non-negative int')
+
         if length is None:
-            length = len(buf)*8
+            length = max(len(buf)*8 - offset, 0)
 
         if length.__class__ is not int:
             raise TypeError('Expected int length; got %s' % length.__class__.__qualname__)
         if length < 0:
             raise ValueError('Length must be non-negative int')
-        if len(buf) * 8 < length:
+        if len(buf) * 8 < offset + length:
             raise ValueError('Length longer than bits in buf')
 
-        self = object().__new__(cls)
-        self.__length = length
-        self.__buf = buf if length else b''
-        return self
+        if not length:
+            return Bits()
+
+        end = offset + length
+        end_byte = (end + 7) // 8
+        value = int.from_bytes(buf[offset // 8:end_byte], 'big') >> (end_byte * 8 - end)
+        return cls.__from_int(value & ((1 << length) - 1), length)
+
+    @classmethod
+    def from_array(cls, array):
+        """Create bits from a one-dimensional NumPy array
+
+        The array must be of bools, or of uint8's that are either 0 or 1.
+        Requires NumPy.
+        """
+        import numpy
+
+        array = numpy.asarray(array)
+        if array.ndim != 1:
+            raise ValueError('Expected one-dimensional array; got %d dimensions' % array.ndim)
+
+        if array.dtype == numpy.uint8:
+            if array.size and array.max() > 1:
+                raise ValueError('uint8 array must only contain 0 and 1')
+        elif array.dtype != numpy.bool_:
+            raise TypeError('Expected bool or uint8 array; got %s' % array.dtype)
+
+        return cls.from_bytes(numpy.packbits(array).tobytes(), len(array))
+
+    def to_int(self):
+        """Return the bits as an int, with the first bit the most significant"""
+        return self.__value
 
     def __iter__(self):
-        for i in range(self.__length):
-            yield (self.__buf[i // 8] >> (7 - i % 8)) & 0b1
+        if self.__length:
+            for bit in format(self.__value, '0%db' % self.__length):
+                yield 1 if bit == '1' else 0
 
     def __len__(self):
         return self.__length
 
-    def __full_width_prefix(self):
-        """Return the part of the buf with full-width bytes"""
-        return self.__buf[0:self.__length // 8]
-
-    def __tail_bits(self):
-        """Return the non-full-width tail, with unused bits masked to zero"""
-        odd_bits = self.__length % 8
-        if odd_bits:
-            return self.__buf[self.__length // 8] & (0xFF << (8 - odd_bits))
-
-        else:
-            return 0
+    def __packed(self):
+        """Return the bits packed into bytes, with unused tail bits zero"""
+        num_bytes = (self.__length + 7) // 8
+        return (self.__value << (num_bytes * 8 - self.__length)).to_bytes(num_bytes, 'big')
 
     def __eq__(self, rhs):
         if self.__class__ is not rhs.__class__:
             return NotImplemented
 
-        if self.__length != rhs.__length:
-            return False
-
-        else:
-            # Lengths are identical. If the buffers are the same, we're done.
-            if self.__full_width_prefix() != rhs.__full_width_prefix():
-                return False
-            else:
-                return self.__tail_bits() == rhs.__tail_bits()
+        return self.__length == rhs.__length and self.__value == rhs.__value
 
     def __lt__(self, rhs):
         if self.__class__ is not rhs.__class__:
             return NotImplemented
 
-        self_fwp = self.__full_width_prefix()
-        rhs_fwp = rhs.__full_width_prefix()
-        if self_fwp < rhs_fwp:
-            return True
+        # Compares the full-width bytes first, as bytes, and only if they're
+        # equal the remaining tail bits; not the same as comparing bit by bit
+        # when the lengths differ.
+        if self.__length == rhs.__length:
+            return self.__value < rhs.__value
 
-        elif self_fwp == rhs_fwp:
-            return self.__tail_bits() < rhs.__tail_bits()
+        self_fwb_length = self.__length // 8
+        rhs_fwb_length = rhs.__length // 8
+        self_fwb = self.__value >> (self.__length % 8)
+        rhs_fwb = rhs.__value >> (rhs.__length % 8)
+
+        shortest_length = min(self_fwb_length, rhs_fwb_length)
+        self_head = self_fwb >> ((self_fwb_length - shortest_length) * 8)
+        rhs_head = rhs_fwb >> ((rhs_fwb_length - shortest_length) * 8)
+
+        if self_head != rhs_head:
+            return self_head < rhs_head
+
+        elif self_fwb_length != rhs_fwb_length:
+            return self_fwb_length < rhs_fwb_length
 
         else:
-            return False
+            return self.__tail_bits() < rhs.__tail_bits()
 
+    def __tail_bits(self):
+        """Return the non-full-width tail as a byte, with unused bits zero"""
+        odd_bits = self.__length % 8
+        return (self.__value & ((1 << odd_bits) - 1)) << (8 - odd_bits) if odd_bits else 0
 
     def __getitem__(self, idx):
         if isinstance(idx, int):
@@ -149,24 +201,21 @@ class Bits:
             if not (0 <= idx < self.__length):
                 raise IndexError('Bits index out of range')
 
-            return (self.__buf[idx // 8] >> (7 - idx % 8)) & 0b1
+            return (self.__value >> (self.__length - 1 - idx)) & 0b1
 
         elif isinstance(idx, slice):
             start, stop, step = idx.indices(self.__length)
 
-            # We can reuse self.__buf if the slice starts at index zero and has a standard step
-            if step == 1 and start == 0:
-                if stop == 0:
+            if step == 1:
+                if stop <= start:
                     return self.__class__()
 
-                elif stop == self.__length:
+                elif start == 0 and stop == self.__length:
                     return self
 
                 else:
-                    r = super().__new__(self.__class__)
-                    r.__length = stop
-                    r.__buf = self.__buf
-                    return r
+                    value = (self.__value >> (self.__length - stop)) & ((1 << (stop - start)) - 1)
+                    return self.__from_int(value, stop - start)
 
             else:
                 # Fallback implementation; user is doing something odd
@@ -187,35 +236,8 @@ class Bits:
             return self
 
         else:
-            # Do we need to shift the bits of the right-hand-side before we concatenate it to our buffer?
-            rhs_offset = self.__length % 8
-            rhs_buf = rhs.__buf
-            if rhs_offset:
-                # Because we have an offset subsequent bytes need to be
-                # "merged" together in pairs.
-                rhs_buf = []
-
-                # Init the tail bits from the tail of the lhs
-                tail_bits = self.__buf[self.__length // 8] & (0xFF << (8 - self.__length % 8))
-
-                # For every byte in the RHS
-                for byte in rhs.__buf[0:rhs.__length // 8 + (1 if rhs.__length % 8 else 0)]:
-                    # For every byte on the rhs, shift it's MSB's right by the
-                    # offset, and or it with the tail bits.
-                    rhs_buf.append(tail_bits | (byte >> rhs_offset))
-
-                    # Then save LSB's as the new tail bits, shifted to the
-                    # left the amount of the offset
-                    tail_bits = (byte << (8 - rhs_offset)) & 0xFF
-
-                # Last tail bits get saved
-                rhs_buf.append(tail_bits)
-                rhs_buf = bytes(rhs_buf)
-
-            r = super().__new__(self.__class__)
-            r.__length = self.__length + rhs.__length
-            r.__buf = self.__buf[0:self.__length // 8] + rhs_buf
-            return r
+            return self.__from_int((self.__value << rhs.__length) | rhs.__value,
+                                   self.__length + rhs.__length)
 
     def __invert__(self):
         # Technically we should check types of self, but... yeah.
@@ -224,10 +246,39 @@ class Bits:
             return self
 
         else:
-            # Can just blindly invert all bytes, as we don't care about what the
-            # unused tail bits end up as.
-            inverted_buf = bytes([~byte & 0xff for byte in self.__buf[:self.__length // 8 + 1]])
-            return Bits.from_bytes(inverted_buf, self.__length)
+            return self.__from_int(self.__value ^ ((1 << self.__length) - 1), self.__length)
+
+    def count(self):
+        """Return the number of bits set"""
+        return bin(self.__value).count('1')
+
+    def iter_set_bits(self):
+        """Iterate over the indexes of the bits that are set, in order"""
+        value = self.__value
+        while value:
+            top = value.bit_length() - 1
+            yield self.__length - 1 - top
+            value ^= 1 << top
+
+    def find_first_difference(self, other):
+        """Return the index of the first bit that differs from other
+
+        If one is a prefix of the other, that's the length of the shorter.
+        Returns None if they're equal.
+        """
+        if self.__class__ is not other.__class__:
+            raise TypeError("Can't compare %s to %s" % \
+                            (self.__class__.__qualname__, other.__class__.__qualname__))
+
+        lhs, rhs = (self, other) if self.__length <= other.__length else (other, self)
+
+        diff_bits = lhs.__value ^ (rhs.__value >> (rhs.__length - lhs.__length))
+        if diff_bits:
+            return lhs.__length - diff_bits.bit_length()
+        elif lhs.__length != rhs.__length:
+            return lhs.__length
+        else:
+            return None
 
     def startswith(self, prefix):
         """Return true if self starts with prefix"""
@@ -235,14 +286,11 @@ class Bits:
             raise TypeError("Can't compute whether <%s>.startswith(<%s>)" % \
                             (self.__class__.__qualname__, prefix.__class__.__qualname__))
 
-        if len(prefix) > len(self):
+        if prefix.__length > self.__length:
             return False
 
-        elif len(prefix) == len(self):
-            return prefix == self
-
         else:
-            return self[:len(prefix)] == prefix
+            return self.__value >> (self.__length - prefix.__length) == prefix.__value
 
     def common_prefix(self, rhs):
         """Return the common prefix"""
@@ -253,41 +301,17 @@ class Bits:
         # Arrange so shorter is the "left-hand-side" and longer is the "right-hand-side"
         lhs, rhs = (self, rhs) if self.__length <= rhs.__length else (rhs, self)
 
-        common_prefix_length = (lhs.__length // 8)*8
-        fwb_eq = False
-        for i in range(lhs.__length // 8):
-            if lhs.__buf[i] != rhs.__buf[i]:
-                # Difference found in full-width bytes
-                common_prefix_length = i * 8
-                break
+        # The highest bit set in the XOR of the two is the first difference.
+        diff_bits = lhs.__value ^ (rhs.__value >> (rhs.__length - lhs.__length))
 
-        else:
-            # No full-width differences found.
-            fwb_eq = True
-
-        # Check remaining bits
-        if common_prefix_length < lhs.__length:
-            # XOR
-            diff_bits = lhs.__buf[common_prefix_length // 8] ^ rhs.__buf[common_prefix_length // 8]
-
-            # and shift left until either the common_prefix_length is the same
-            # length as the lhs, or we find a difference
-            while common_prefix_length < lhs.__length and not diff_bits & 0x80:
-                diff_bits = (diff_bits << 1) & 0xFF
-                common_prefix_length += 1
-
-        assert common_prefix_length <= lhs.__length
-
-        # If the common prefix is the same length as the lhs length, then we
-        # can just return the lhs directly
-        if common_prefix_length == lhs.__length:
-            assert fwb_eq
+        # If there's no difference the common prefix is the lhs, which we can
+        # return directly
+        if not diff_bits:
             return lhs
 
-        # Otherwise, return a new Bits using the lhs's buffer with the common
-        # prefix length
         else:
-            return Bits.from_bytes(lhs.__buf, common_prefix_length)
+            common_prefix_length = lhs.__length - diff_bits.bit_length()
+            return self.__from_int(lhs.__value >> diff_bits.bit_length(), common_prefix_length)
 
 
 
@@ -300,18 +324,18 @@ class BitsSerializer(proofmarshal.serialize.Serializer):
     @classmethod
     def ctx_serialize(cls, value, ctx):
         """Serialize to a context"""
-        ctx.write_varuint(value._Bits__length)
-        ctx.write_bytes(value._Bits__full_width_prefix())
-        if value._Bits__length % 8:
-            ctx.write_bytes(bytes([value._Bits__tail_bits()]))
+        ctx.write_varuint(len(value))
+        ctx.write_bytes(value._Bits__packed())
 
     @classmethod
     def ctx_deserialize(cls, ctx):
         """Deserialize from a context"""
         length = ctx.read_varuint()
-        buf = ctx.read_bytes(length // 8 + (1 if length % 8 else 0))
-        r = Bits.from_bytes(buf, length)
-        # FIXME: should throw a serialization exception
-        assert r._Bits__tail_bits() == buf[-1]
-        return r
+        num_bytes = (length + 7) // 8
+        buf = ctx.read_bytes(num_bytes)
+
+        unused_bits = num_bytes * 8 - length
+        if buf and buf[-1] & ((1 << unused_bits) - 1):
+            raise proofmarshal.serialize.DeserializationError('Bits padding must be zero')
 
+        return Bits.from_bytes(buf, length)
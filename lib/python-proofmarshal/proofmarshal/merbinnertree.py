@@ -9,6 +9,7 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import collections
 import hashlib
 import hmac
 import operator
@@ -94,24 +95,95 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
     KEY_SERIALIZER = None
     VALUE_SERIALIZER = None
 
+    # How many recently used keys to cache the prefixes of; see PrefixCache
+    PREFIX_CACHE_SIZE = 65536
+
     @staticmethod
     def key2prefix(key):
         return key.hash
 
     def __new__(cls, iterable=()):
-        """Create a new merbinner tree"""
+        """Create a new merbinner tree
+
+        If a key is given more than once, the last value is used, the same as
+        put()ing each item in turn. Keys are compared by prefix.
+        """
 
         if hasattr(iterable, 'items'):
             iterable = iterable.items()
 
-        self = cls.EmptyNodeClass()
+        # Keys are deduplicated by prefix, as they needn't be hashable.
+        leaf_cls = cls.LeafNodeClass
+        nodes = {}
         for key, value in iterable:
-            self = self.put(key, value)
-        return self
+            prefix = cls._key2prefix(key)
+            nodes[_prefix_id(prefix)] = (prefix, leaf_cls._from_prefix(prefix, key, value))
+        return cls._join(list(nodes.values()))
+
+    @classmethod
+    def _join(cls, nodes):
+        """Join subtrees together into a single tree, bottom-up
+
+        nodes is a list of (prefix, subtree) tuples, none of which may be
+        empty. Rather than put() each item in turn, creating and discarding
+        inner nodes along the way, the subtrees are sorted by prefix and the
+        final inner nodes created directly; the inner node joining two
+        adjacent subtrees has their common prefix.
+
+        Raises ValueError if the subtrees can't be joined, as one prefix
+        starts with another.
+        """
+        if not nodes:
+            return cls.EmptyNodeClass()
+
+        # Sort in tree order, by comparing the prefixes bit by bit; Bits sort
+        # by their full-width bytes first, which isn't tree order for
+        # prefixes of different lengths.
+        width = max(len(prefix) for prefix, node in nodes)
+        nodes = sorted(nodes, key=lambda item: item[0].to_int() << (width - len(item[0])))
+        return cls.__join_sorted(nodes)
+
+    @classmethod
+    def __join_sorted(cls, nodes):
+        """Join subtrees sorted in tree order"""
+        new_inner = cls.InnerNodeClass._from_children
+
+        # Stack of (subtree, prefix of the inner node joining it to the
+        # subtree to its right), with the prefixes getting longer towards the
+        # top of the stack.
+        stack = []
+        prev_prefix, tip = nodes[0]
+        for prefix, node in nodes[1:]:
+            common_prefix = prev_prefix.common_prefix(prefix)
+            n = len(common_prefix)
+
+            # Adjacent subtrees must diverge, in order, which they do unless
+            # one prefix starts with the other.
+            if not (n < len(prev_prefix) and n < len(prefix)
+                    and not prev_prefix[n] and prefix[n]):
+                raise ValueError('prefix %r overlaps prefix %r' % (prev_prefix, prefix))
+
+            # Subtrees joined by longer prefixes are complete.
+            while stack and len(stack[-1][1]) > n:
+                left, left_prefix = stack.pop()
+                tip = new_inner(left, tip, left_prefix)
+
+            # Can't happen with subtrees sorted in tree order.
+            assert not (stack and len(stack[-1][1]) == n)
+
+            stack.append((tip, common_prefix))
+            tip = node
+            prev_prefix = prefix
+
+        while stack:
+            left, left_prefix = stack.pop()
+            tip = new_inner(left, tip, left_prefix)
+
+        return tip
 
     def __getitem__(self, key):
         """Return the value associated with the key"""
-        closest_node, *_ = self.descend(self.key2prefix(key))
+        closest_node, *_ = self.descend(self._key2prefix(key))
         try:
             if closest_node.key == key:
                 return closest_node.value
@@ -120,17 +192,49 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
         raise KeyError(key)
 
     def __contains__(self, key):
-        raise NotImplementedError
+        closest_node = next(self.descend(self._key2prefix(key)))
+        return closest_node.__class__ is self.LeafNodeClass and closest_node.key == key
 
     def __len__(self):
         raise NotImplementedError
 
+    def _cached_len(self):
+        """Return the length if it can be found without walking the tree
+
+        Returns None otherwise.
+        """
+        return None
+
     def __iter__(self):
         yield from self.keys()
 
     def items(self):
-        for (key, value) in zip(self.keys(), self.values()):
-            yield (key, value)
+        for leaf in self._iter_leaves():
+            yield (leaf.key, leaf.value)
+
+    def _iter_leaves(self):
+        """Iterate over the leaf nodes in order
+
+        Uses an explicit stack, rather than nested generators, so every leaf
+        costs O(1) regardless of depth.
+        """
+        inner_cls = self.InnerNodeClass
+        leaf_cls = self.LeafNodeClass
+        empty_cls = self.EmptyNodeClass
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, inner_cls):
+                stack.append(node.right)
+                stack.append(node.left)
+
+            elif isinstance(node, leaf_cls):
+                yield node
+
+            elif not isinstance(node, empty_cls):
+                # Fully pruned nodes deserialize as instances of the base class
+                raise proofmarshal.proof.PrunedError('key', node)
 
     def keys(self):
         raise NotImplementedError
@@ -140,7 +244,8 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
     def put(self, key, value):
         """Set key to value
 
-        Returns a new tree with that key set.
+        Returns a new tree with that key set, replacing any existing value.
+        Keys are compared by prefix.
         """
         # Guaranteed to end up creating a new leaf node, so do that now.
         new_leaf = self.LeafNodeClass(key, value)
@@ -151,6 +256,13 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
             # Was replaced
             return new_leaf
 
+        elif closest_node.__class__ is self.LeafNodeClass and closest_node.prefix == new_leaf.prefix:
+            # Existing key, so the new leaf replaces it
+            new_tip = new_leaf
+            for sibling in siblings:
+                new_tip = self.InnerNodeClass(new_tip, sibling)
+            return new_tip
+
         else:
             # The two leaves are joined by an inner node
             new_tip = self.InnerNodeClass(new_leaf, closest_node)
@@ -168,7 +280,7 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
         Returns a new tree with that key removed.
         """
         # Guaranteed to end up creating a new leaf node, so do that now.
-        siblings = self.descend(self.key2prefix(key))
+        siblings = self.descend(self._key2prefix(key))
         closest_node = next(siblings) # guaranteed to succeed
 
         if closest_node.__class__ is self.LeafNodeClass:
@@ -188,6 +300,144 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
 
         raise KeyError(key)
 
+    def update(self, puts=(), removes=()):
+        """Put and remove many keys at once
+
+        puts is a mapping, or an iterable of (key, value) pairs, and removes
+        an iterable of keys. The same as calling put() and remove() for each
+        key, but done in a single traversal of the tree, with every affected
+        inner node rebuilt once.
+
+        Returns a new tree. Raises KeyError if a key to be removed isn't in
+        the tree, and ValueError if a key is both put and removed.
+        """
+        if hasattr(puts, 'items'):
+            puts = puts.items()
+
+        # (prefix, key, value, remove) tuples, deduplicated by prefix as keys
+        # needn't be hashable.
+        put_changes = {}
+        for key, value in puts:
+            prefix = self._key2prefix(key)
+            put_changes[_prefix_id(prefix)] = (prefix, key, value, False)
+
+        remove_changes = {}
+        for key in removes:
+            prefix = self._key2prefix(key)
+            remove_changes[_prefix_id(prefix)] = (prefix, key, None, True)
+
+        both = [change[1] for prefix_id, change in remove_changes.items()
+                          if prefix_id in put_changes]
+        if both:
+            raise ValueError('keys both put and removed: %r' % both)
+
+        changes = list(put_changes.values())
+        changes.extend(remove_changes.values())
+
+        if not changes:
+            return self
+        return self._update(changes)
+
+    def _update(self, changes):
+        """Implementation of update()
+
+        changes is a non-empty list of (prefix, key, value, remove) tuples.
+        """
+        raise NotImplementedError
+
+    def diff(self, other):
+        """Find the differences between this tree and other
+
+        Yields (action, key, value) tuples in key order, where action is one
+        of 'added', 'removed' or 'changed'. The value is the one in other,
+        except for removed keys, where it's the one in self. Putting the added
+        and changed items and removing the removed keys turns self into other.
+
+        Subtrees with the same hash are skipped without looking inside them,
+        so if the trees share most of their nodes this is O(changes * depth).
+        """
+        if other.__class__.__base__ is not self.__class__.__base__:
+            raise TypeError('other must be of same class as self to compute diff()')
+
+        empty_cls = self.EmptyNodeClass
+
+        # Stack of (ours, theirs) pairs of subtrees to compare; either can be
+        # None, meaning everything in the other side was added or removed.
+        stack = [(self, other)]
+        while stack:
+            ours, theirs = stack.pop()
+
+            if ours is None:
+                for leaf in theirs._iter_leaves():
+                    yield ('added', leaf.key, leaf.value)
+
+            elif theirs is None:
+                for leaf in ours._iter_leaves():
+                    yield ('removed', leaf.key, leaf.value)
+
+            elif ours.hash == theirs.hash:
+                pass
+
+            elif ours.__class__ is empty_cls:
+                stack.append((None, theirs))
+
+            elif theirs.__class__ is empty_cls:
+                stack.append((ours, None))
+
+            elif (ours.__class__ is theirs.__class__ is self.LeafNodeClass
+                  and ours.key == theirs.key):
+                yield ('changed', theirs.key, theirs.value)
+
+            else:
+                our_prefix = ours.prefix
+                their_prefix = theirs.prefix
+                n = len(our_prefix)
+                m = len(their_prefix)
+
+                if our_prefix == their_prefix:
+                    stack.append((ours.right, theirs.right))
+                    stack.append((ours.left, theirs.left))
+
+                elif n < m and their_prefix.startswith(our_prefix):
+                    # They're entirely under one of our sides.
+                    if their_prefix[n]:
+                        stack.append((ours.right, theirs))
+                        stack.append((ours.left, None))
+                    else:
+                        stack.append((ours.right, None))
+                        stack.append((ours.left, theirs))
+
+                elif m < n and our_prefix.startswith(their_prefix):
+                    # We're entirely under one of their sides.
+                    if our_prefix[m]:
+                        stack.append((ours, theirs.right))
+                        stack.append((None, theirs.left))
+                    else:
+                        stack.append((None, theirs.right))
+                        stack.append((ours, theirs.left))
+
+                else:
+                    # Nothing in common.
+                    if our_prefix[len(our_prefix.common_prefix(their_prefix))]:
+                        stack.append((ours, None))
+                        stack.append((None, theirs))
+                    else:
+                        stack.append((None, theirs))
+                        stack.append((ours, None))
+
+    def prove_diff(self, other):
+        """Create a proof of the differences between this tree and other
+
+        Returns a (pruned self, pruned other) tuple, with everything diff()
+        uses unpruned; calling diff() on them gives the same result as on
+        the originals.
+        """
+        proof = self.prune()
+        other_proof = other.prune()
+        for change in proof.diff(other_proof):
+            pass
+        return (proof, other_proof)
+
     def descend(self, prefix):
         """Descend into the tree
 
@@ -230,7 +480,97 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
         else:
             return self._MerbinnerTree__issubset(other)
 
+def _prefix_id(prefix):
+    """Return a hashable stand-in for a prefix, as Bits aren't hashable"""
+    return (len(prefix), prefix.to_int())
+
+class PrefixCache:
+    """Cache of the prefixes of recently used keys
+
+    Calling the cache with a key returns key2prefix(key) as Bits, cached if
+    key2prefix() is worth avoiding. Bytes and int keys are small, immutable,
+    and equal only if their serializations are, so they're cached as-is.
+    Other keys are cached by their hash if key_serializer provides one, or
+    else by their serialization; thus equal keys share an entry, unhashable
+    keys are fine, and the keys themselves - often large proofs - aren't kept
+    alive by the cache.
+
+    If key_serializer is None only bytes and int keys are cached. Use that
+    when key2prefix() is the key's hash, which costs as much to compute as
+    the cache key would.
+    """
+
+    def __init__(self, key2prefix, key_serializer, maxsize):
+        self.key2prefix = key2prefix
+        if key_serializer is None:
+            self.cache_key = None
+        else:
+            try:
+                self.cache_key = key_serializer.get_hash
+            except AttributeError:
+                self.cache_key = key_serializer.serialize
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+
+    @classmethod
+    def for_class(cls, subclass, default_key2prefix):
+        """Create the cache for a class with key2prefix() and KEY_SERIALIZER
+
+        Keys are only cached by hash or serialization if key2prefix() has
+        been overridden.
+        """
+        key_serializer = subclass.KEY_SERIALIZER
+        if subclass.key2prefix is default_key2prefix:
+            key_serializer = None
+        return cls(subclass.key2prefix, key_serializer, subclass.PREFIX_CACHE_SIZE)
+
+    def __call__(self, key):
+        if key.__class__ in (bytes, int):
+            cache_key = key
+        elif self.cache_key is not None:
+            cache_key = self.cache_key(key)
+        else:
+            return self._key2prefix(key)
+
+        cache = self.cache
+        try:
+            prefix = cache[cache_key]
+            cache.move_to_end(cache_key)
+            return prefix
+        except KeyError:
+            pass
+
+        prefix = self._key2prefix(key)
+        cache[cache_key] = prefix
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return prefix
+
+    def _key2prefix(self, key):
+        prefix = self.key2prefix(key)
+        if prefix.__class__ is not Bits:
+            prefix = Bits.from_bytes(prefix)
+        return prefix
+
+def cached_prefix_property(slot_name):
+    """Make a leaf node prefix property, cached in the named slot
+
+    The slot isn't serialized, so the prefix never affects the hash.
+    """
+    def prefix(self):
+        # Direct slot access, as going through __getattr__ would try to
+        # unprune a pruned node.
+        try:
+            return object.__getattribute__(self, slot_name)
+        except AttributeError:
+            prefix = self._key2prefix(self.key)
+            object.__setattr__(self, slot_name, prefix)
+            return prefix
+    return property(prefix)
+
 def make_MerbinnerTree_subclass(subclass):
+    subclass._key2prefix = PrefixCache.for_class(subclass, MerbinnerTree.key2prefix)
+
     @subclass.declare_variant
     class MerbinnerTreeEmptyNodeClass(subclass):
         """The empty node"""
@@ -253,6 +593,9 @@ def make_MerbinnerTree_subclass(subclass):
         def __len__(self):
             return 0
 
+        def _cached_len(self):
+            return 0
+
         def keys(self):
             yield from ()
 
@@ -262,6 +605,15 @@ def make_MerbinnerTree_subclass(subclass):
         def descend(self, prefix):
             yield self
 
+        def _update(self, changes):
+            leaf_cls = self.LeafNodeClass
+            nodes = []
+            for prefix, key, value, remove in changes:
+                if remove:
+                    raise KeyError(key)
+                nodes.append((prefix, leaf_cls._from_prefix(prefix, key, value)))
+            return self._join(nodes)
+
         def _MerbinnerTree__issubset(self, other):
             # Nothing is a subset of anything
             return True
@@ -274,21 +626,30 @@ def make_MerbinnerTree_subclass(subclass):
         """Leaf node"""
         SUB_HASHTAG = proofmarshal.proof.HashTag('f5cc855e-9d21-4f8d-ab42-7883c765c323')
 
-        __slots__ = ['key','value']
+        # The prefix is cached, but isn't serialized, so never affects the hash.
+        __slots__ = ['key','value','__prefix']
         SERIALIZED_ATTRS = [('key',   subclass.KEY_SERIALIZER),
                             ('value', subclass.VALUE_SERIALIZER)]
 
-        @property
-        def prefix(self):
-            return self.key2prefix(self.key)
+        prefix = cached_prefix_property('_MerbinnerTreeLeafNode__prefix')
 
         def __new__(cls, key, value):
             """Create a merbinner tree leaf node"""
             return proofmarshal.proof.VarProof.__new__(cls, key=key, value=value)
 
+        @classmethod
+        def _from_prefix(cls, prefix, key, value):
+            """Create a leaf node whose prefix is already known"""
+            self = proofmarshal.proof.VarProof.__new__(cls, key=key, value=value)
+            object.__setattr__(self, '_MerbinnerTreeLeafNode__prefix', prefix)
+            return self
+
         def __len__(self):
             return 1
 
+        def _cached_len(self):
+            return 1
+
         def keys(self):
             yield self.key
 
@@ -298,6 +659,24 @@ def make_MerbinnerTree_subclass(subclass):
         def descend(self, prefix):
             yield self
 
+        def _update(self, changes):
+            leaf_cls = self.LeafNodeClass
+            nodes = []
+            keep_self = True
+            for prefix, key, value, remove in changes:
+                if key == self.key:
+                    # Replaced or removed
+                    keep_self = False
+                    if remove:
+                        continue
+                elif remove:
+                    raise KeyError(key)
+                nodes.append((prefix, leaf_cls._from_prefix(prefix, key, value)))
+
+            if keep_self:
+                nodes.append((self.prefix, self))
+            return self._join(nodes)
+
         def _MerbinnerTree__issubset(self, other):
             try:
                 other_value = other[self.key]
@@ -312,7 +691,8 @@ def make_MerbinnerTree_subclass(subclass):
         """Inner node, contains two children"""
         SUB_HASHTAG = proofmarshal.proof.HashTag('66d74741-0ffd-4178-9a79-641a45e23dda')
 
-        __slots__ = ['left','right','prefix']
+        # The length is cached, but isn't serialized, so never affects the hash.
+        __slots__ = ['left','right','prefix','__length']
         SERIALIZED_ATTRS = [('prefix', BitsSerializer),
                             ('left',  subclass),
                             ('right', subclass)]
@@ -337,18 +717,47 @@ def make_MerbinnerTree_subclass(subclass):
             # order by the next bit after us.
             left,right = (first,second) if second.prefix[len(prefix)] else (second, first)
 
-            return proofmarshal.proof.VarProof.__new__(cls, left=left, right=right, prefix=prefix)
+            return cls._from_children(left, right, prefix)
+
+        @classmethod
+        def _from_children(cls, left, right, prefix):
+            """Create an inner node, without any checks"""
+            self = proofmarshal.proof.VarProof.__new__(cls, left=left, right=right, prefix=prefix)
+
+            left_length = left._cached_len()
+            right_length = right._cached_len()
+            if left_length is not None and right_length is not None:
+                object.__setattr__(self, '_MerbinnerTreeInnerNode__length', left_length + right_length)
+
+            return self
 
         def __len__(self):
-            return len(self.left) + len(self.right)
+            length = self._cached_len()
+            if length is None:
+                length = len(self.left) + len(self.right)
+
+                # Pruned nodes are only ever partially unpruned, so their
+                # length isn't cached.
+                if not self.is_pruned:
+                    object.__setattr__(self, '_MerbinnerTreeInnerNode__length', length)
+
+            return length
+
+        def _cached_len(self):
+            # Direct slot access, as going through __getattr__ would try to
+            # unprune a pruned node.
+            try:
+                return object.__getattribute__(self, '_MerbinnerTreeInnerNode__length')
+            except AttributeError:
+                return None
 
         def keys(self):
-            yield from self.left.keys()
-            yield from self.right.keys()
+            for leaf in self._iter_leaves():
+                yield leaf.key
 
         def values(self):
-            yield from self.left.values()
-            yield from self.right.values()
+            for leaf in self._iter_leaves():
+                yield leaf.value
 
         def descend(self, prefix):
             if len(self.prefix) <= len(prefix) and prefix.startswith(self.prefix):
@@ -367,6 +776,54 @@ def make_MerbinnerTree_subclass(subclass):
                 # closest match, terminating the descent.
                 yield self
 
+        def _update(self, changes):
+            prefix = self.prefix
+            n = len(prefix)
+
+            # Sort the changes into those under our left and right sides, and
+            # puts that end up outside of us entirely.
+            left_changes = []
+            right_changes = []
+            outside = []
+            for change in changes:
+                change_prefix = change[0]
+                if len(change_prefix) > n and change_prefix.startswith(prefix):
+                    if change_prefix[n]:
+                        right_changes.append(change)
+                    else:
+                        left_changes.append(change)
+
+                elif change[3]:
+                    raise KeyError(change[1])
+
+                else:
+                    outside.append((change_prefix,
+                                    self.LeafNodeClass._from_prefix(change_prefix, change[1], change[2])))
+
+            left = self.left._update(left_changes) if left_changes else self.left
+            right = self.right._update(right_changes) if right_changes else self.right
+
+            empty_cls = self.EmptyNodeClass
+            if left is self.left and right is self.right:
+                tip = self
+            elif left.__class__ is empty_cls:
+                tip = right
+            elif right.__class__ is empty_cls:
+                tip = left
+            else:
+                # Both sides are still non-empty, so our prefix is unchanged.
+                tip = self._from_children(left, right, prefix)
+
+            if outside:
+                # _join() sorts in tree order, so tip is joined to the outside
+                # leaves as a whole, despite its shorter prefix.
+                if tip.__class__ is not empty_cls:
+                    outside.append((tip.prefix, tip))
+                return self._join(outside)
+
+            else:
+                return tip
+
         def _MerbinnerTree__issubset(self, them):
             if self == them:
                 return True
@@ -9,11 +9,15 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import bisect
 import hashlib
 import hmac
 import operator
+import os
+import struct
 
 import proofmarshal.proof
+import proofmarshal.serialize
 
 """(Summed) Merkle Mountain Range support
 
@@ -242,17 +246,212 @@ class MerkleMountainRange(proofmarshal.proof.VarProof):
         """
         return self.LeafNodeClass(value)
 
+    def _peaks(self):
+        """Find the mountain peaks of the MMR
+
+        Returns a list of (peak, length) tuples, from left to right, and a
+        list of the nodes folding those peaks together; the i'th node commits
+        to the first i+1 peaks.
+        """
+        peaks = []
+        folds = []
+
+        node = self
+        l = len(node)
+        if l:
+            # Peaks are perfect trees, and thus the only nodes whose length is
+            # a power of two.
+            while l & (l - 1):
+                folds.append(node)
+                peaks.append((node.right, len(node.right)))
+                node = node.left
+                l = len(node)
+
+            folds.append(node)
+            peaks.append((node, l))
+
+        peaks.reverse()
+        folds.reverse()
+        return (peaks, folds)
+
     def extend(self, values):
         """Extend MMR from an iterable
 
         Returns a new MMR instance.
         """
-        r = self
+        # Rather than appending values one at a time we build the mountains
+        # bottom-up, merging peaks of the same size as we go, and only then
+        # fold the final peaks together. Nodes that append() would discard
+        # immediately are never created.
+        peaks, folds = self._peaks()
+        unchanged = len(peaks)
+
+        new_node = proofmarshal.proof.VarProof.__new__
+        leaf_cls = self.LeafNodeClass
+        inner_cls = self.InnerNodeClass
         for value in values:
-            r = r.append(value)
+            node = leaf_cls(value)
+            length = 1
+
+            while peaks and peaks[-1][1] == length:
+                left = peaks.pop()[0]
+                node = new_node(inner_cls, left=left, right=node, length=length * 2)
+                length *= 2
+
+            unchanged = min(unchanged, len(peaks))
+            peaks.append((node, length))
+
+        if unchanged == len(peaks):
+            # Nothing was added.
+            return self
+
+        # Fold the peaks left-to-right, starting from the fold of the peaks
+        # that didn't change, if any.
+        if unchanged:
+            r = folds[unchanged - 1]
+            r_length = sum(length for node, length in peaks[0:unchanged])
+        else:
+            r, r_length = peaks[0]
+            unchanged = 1
+
+        for node, length in peaks[unchanged:]:
+            r_length += length
+            r = new_node(inner_cls, left=r, right=node, length=r_length)
+
+        return r
+
+    def prove(self, indices):
+        """Create a proof of the values at indices
+
+        Returns a pruned version of the MMR with the values at indices, and
+        everything needed to look them up, unpruned. This is the same as
+        pruning the MMR and looking up each index in turn, but in a single
+        traversal of the tree.
+        """
+        indices = list(indices)
+        if not indices:
+            return self.prune()
+
+        n = len(self)
+        wanted = set()
+        for idx in indices:
+            if idx < 0:
+                idx += n
+            if not (0 <= idx < n):
+                raise IndexError('index out of range')
+            wanted.add(idx)
+
+        wanted = sorted(wanted)
+        return self._prove(wanted, 0, len(wanted), 0)
 
+    def _prefix(self, length):
+        """Return a MMR of the first length values
+
+        The peaks of MMR(D[0:length]) are all perfect trees that already
+        exist in this MMR, so rather than rebuilding them we find them and
+        fold them together; O(log n) rather than O(length).
+        """
+        if length >= len(self):
+            return self
+        elif length <= 0:
+            return self.EmptyNodeClass()
+
+        # Walk down the tree, collecting the nodes that make up the prefix
+        # from left to right. The first part can be a fold of several peaks,
+        # as left-folding it with the remaining peaks gives the same tree as
+        # left-folding those peaks individually; every other part is a perfect
+        # tree.
+        #
+        # Child lengths follow from the shape of the MMR: perfect trees split
+        # in half, and the right side of a fold is its smallest peak. Not
+        # looking them up keeps prefix proofs minimal.
+        parts = []
+        node = self
+        node_length = len(self)
+        while length:
+            if node_length == length:
+                parts.append((node, node_length))
+                break
+
+            if node_length & (node_length - 1):
+                left_length = node_length - (node_length & -node_length)
+            else:
+                left_length = node_length // 2
+
+            if length <= left_length:
+                node = node.left
+                node_length = left_length
+            else:
+                parts.append((node.left, left_length))
+                length -= left_length
+                node = node.right
+                node_length -= left_length
+
+        new_node = proofmarshal.proof.VarProof.__new__
+        inner_cls = self.InnerNodeClass
+        r, r_length = parts[0]
+        for node, node_length in parts[1:]:
+            r_length += node_length
+            r = new_node(inner_cls, left=r, right=node, length=r_length)
         return r
 
+    def prove_prefix(self, length):
+        """Prove that an older MMR of length values is a prefix of this one
+
+        Returns a pruned version of the MMR with everything needed to compute
+        self[0:length] unpruned. Given the hash of the older MMR, a verifier
+        checks that proof[0:length].hash matches it, and that proof.hash
+        matches the hash of this MMR.
+
+        Note that if length is zero, or the length of this MMR, the proof
+        needs nothing more than the hash of this MMR.
+        """
+        if not (0 <= length <= len(self)):
+            raise IndexError('prefix length out of range')
+
+        proof = self.prune()
+        proof._prefix(length)
+        return proof
+
+    def _prove(self, indices, lo, hi, offset):
+        """Prove indices[lo:hi], relative to offset
+
+        indices[lo:hi] must not be empty.
+        """
+        raise NotImplementedError
+
+    def _prune_length(self):
+        """Prune everything but what is needed to find the length"""
+        raise NotImplementedError
+
+    def _iter_leaves(self, reverse=False):
+        """Iterate over the leaf nodes, in order or reversed
+
+        Uses an explicit stack, rather than nested generators, so every leaf
+        costs O(1) regardless of depth.
+        """
+        inner_cls = self.InnerNodeClass
+        leaf_cls = self.LeafNodeClass
+        empty_cls = self.EmptyNodeClass
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, inner_cls):
+                if reverse:
+                    stack.append(node.left)
+                    stack.append(node.right)
+                else:
+                    stack.append(node.right)
+                    stack.append(node.left)
+
+            elif isinstance(node, leaf_cls):
+                yield node
+
+            elif not isinstance(node, empty_cls):
+                # Fully pruned nodes deserialize as instances of the base class
+                raise proofmarshal.proof.PrunedError('value', node)
+
     def __repr__(self):
         # Why __base__? Because this will be called in subclasses, and we want
         # to represent a MMR with the base class name, which will in turn be a
@@ -310,6 +509,9 @@ def make_mmr_subclass(subclass):
         def __reversed__(self):
             yield from ()
 
+        def _prune_length(self):
+            return self.prune()
+
         def append(self, value):
             """Append object to end of MMR
 
@@ -366,6 +568,17 @@ def make_mmr_subclass(subclass):
         def __reversed__(self):
             yield self.value
 
+        def _prove(self, indices, lo, hi, offset):
+            # Values that are proofs are pruned, as looking them up in a
+            # pruned leaf would.
+            value = self.value
+            if isinstance(value, proofmarshal.proof.Proof):
+                value = value.prune()
+            return self._prune_with(value=value)
+
+        def _prune_length(self):
+            return self.prune()
+
         def append(self, new_value):
             """Append object to end of MMR
 
@@ -424,6 +637,13 @@ def make_mmr_subclass(subclass):
                     # ourselves
                     return self
 
+                if start >= stop:
+                    return self.EmptyNodeClass()
+
+                if start <= 0:
+                    # Prefixes reuse the perfect trees we already have.
+                    return self._prefix(stop)
+
                 if start < len(self.left):
                     # Left side satisfies at least part of the slice.
                     r = self.left[start:stop:step]
@@ -447,12 +667,31 @@ def make_mmr_subclass(subclass):
                 raise TypeError('expected int or slice; got %r' % idx.__class__)
 
         def __iter__(self):
-            yield from self.left
-            yield from self.right
+            for leaf in self._iter_leaves():
+                yield leaf.value
 
         def __reversed__(self):
-            yield from reversed(self.right)
-            yield from reversed(self.left)
+            for leaf in self._iter_leaves(reverse=True):
+                yield leaf.value
+
+        def _prove(self, indices, lo, hi, offset):
+            left_length = len(self.left)
+            split = bisect.bisect_left(indices, offset + left_length, lo, hi)
+
+            if lo < split:
+                left = self.left._prove(indices, lo, split, offset)
+            else:
+                left = self.left._prune_length()
+
+            if split < hi:
+                right = self.right._prove(indices, split, hi, offset + left_length)
+            else:
+                right = self.right.prune()
+
+            return self._prune_with(left=left, right=right, length=self.length)
+
+        def _prune_length(self):
+            return self._prune_with(length=self.length)
 
         def _merge_trees(self, new_right):
             assert len(self) >= len(new_right)
@@ -505,3 +744,477 @@ def make_mmr_subclass(subclass):
     subclass.InnerNodeClass = MerkleMountainRangeInnerNode
 
     return subclass
+
+
+def _leaf_data_hash(mmr_class, value):
+    """Calculate the data hash of a leaf node without creating it"""
+    value_serializer = mmr_class.VALUE_SERIALIZER
+    value_serializer.check_instance(value)
+
+    hasher = hashlib.sha256()
+    if issubclass(value_serializer, proofmarshal.serialize.HashingSerializer):
+        hasher.update(value_serializer.get_hash(value))
+    else:
+        value_serializer.ctx_serialize(value, proofmarshal.serialize.HashingSerializationContext(hasher))
+    return hasher.digest()
+
+def _inner_data_hash(left_hash, right_hash, length):
+    """Calculate the data hash of an inner node without creating it"""
+    return hashlib.sha256(left_hash + right_hash + proofmarshal.serialize.encode_varuint(length)).digest()
+
+def _fold_peaks(mmr_class, peaks):
+    """Fold (length, hash) peaks together, yielding (data_hash, hash) of every fold
+
+    The data hash of the first peak by itself is None.
+    """
+    inner_hashtag = mmr_class.InnerNodeClass.HASHTAG
+
+    acc_length, acc_hash = peaks[0]
+    yield (None, acc_hash)
+    for length, peak_hash in peaks[1:]:
+        acc_length += length
+        data_hash = _inner_data_hash(acc_hash, peak_hash, acc_length)
+        acc_hash = inner_hashtag(data_hash).digest()
+        yield (data_hash, acc_hash)
+
+class CompactMerkleMountainRange:
+    """Array-backed storage of a merkle mountain range
+
+    Rather than a tree of Proof objects, the data hashes of the nodes in the
+    mountains are stored in a flat array in post-order, and the values in a
+    list. Node objects of mmr_class, a class made by make_mmr_subclass(), are
+    only created when a proof is asked for; the hashes are identical.
+    """
+
+    DIGEST_LENGTH = 32
+
+    def __init__(self, mmr_class, iterable=()):
+        self.mmr_class = mmr_class
+
+        # (length, hash) of every mountain peak, left to right
+        self._peaks = []
+
+        self._open()
+        self.extend(iterable)
+
+    def _open(self):
+        """Set up storage, along with the peaks of any values already stored"""
+        self.data_hashes = bytearray()
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, int):
+            if idx < 0:
+                idx += len(self)
+            if not (0 <= idx < len(self)):
+                raise IndexError('index out of range')
+            return self._value_at(idx)
+
+        elif isinstance(idx, slice):
+            # Returns an instance of mmr_class, as slicing one would.
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise NotImplementedError
+            return self.mmr_class(self._value_at(i) for i in range(start, stop))
+
+        else:
+            raise TypeError('expected int or slice; got %r' % idx.__class__)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def _value_at(self, idx):
+        return self.values[idx]
+
+    def _data_hash_at(self, pos):
+        start = pos * self.DIGEST_LENGTH
+        return bytes(self.data_hashes[start:start + self.DIGEST_LENGTH])
+
+    def _store(self, value, data_hashes):
+        """Store a new value, and the data hashes of the nodes added for it"""
+        self.values.append(value)
+        for data_hash in data_hashes:
+            self.data_hashes += data_hash
+
+    def append(self, value):
+        """Append a value to the end of the MMR"""
+        inner_hashtag = self.mmr_class.InnerNodeClass.HASHTAG
+
+        data_hash = _leaf_data_hash(self.mmr_class, value)
+        node_hash = self.mmr_class.LeafNodeClass.HASHTAG(data_hash).digest()
+        new_data_hashes = [data_hash]
+
+        length = 1
+        peaks = list(self._peaks)
+        while peaks and peaks[-1][0] == length:
+            left_hash = peaks.pop()[1]
+            length *= 2
+            data_hash = _inner_data_hash(left_hash, node_hash, length)
+            node_hash = inner_hashtag(data_hash).digest()
+            new_data_hashes.append(data_hash)
+
+        peaks.append((length, node_hash))
+
+        self._store(value, new_data_hashes)
+        self._peaks = peaks
+
+    def extend(self, values):
+        """Append values from an iterable"""
+        for value in values:
+            self.append(value)
+
+    def _fold_peaks(self):
+        return _fold_peaks(self.mmr_class, self._peaks)
+
+    @property
+    def data_hash(self):
+        if not self._peaks:
+            return self.mmr_class.EmptyNodeClass().data_hash
+
+        elif len(self._peaks) == 1:
+            return self._data_hash_at(2*self._peaks[0][0] - 2)
+
+        else:
+            for data_hash, fold_hash in self._fold_peaks():
+                pass
+            return data_hash
+
+    @property
+    def hash(self):
+        if not self._peaks:
+            return self.mmr_class.EmptyNodeClass().hash
+
+        for data_hash, fold_hash in self._fold_peaks():
+            pass
+        return fold_hash
+
+    def _make_mountain_node(self, pos, offset, length, indices, need_length=False):
+        """Make the node of a mountain
+
+        pos is the position of the first node in the mountain, offset the
+        index of the first value, and indices the sorted indices of the values
+        to leave unpruned. If need_length is true the length of the node is
+        left unpruned even if nothing else is, as indexing an inner node needs
+        the length of its left child.
+        """
+        inner_cls = self.mmr_class.InnerNodeClass
+
+        if not indices:
+            if length == 1:
+                return self.mmr_class.LeafNodeClass.from_data_hash(self._data_hash_at(pos))
+
+            elif not need_length:
+                return inner_cls.from_data_hash(self._data_hash_at(pos + 2*length - 2))
+
+        if length == 1:
+            return self.mmr_class.LeafNodeClass(self._value_at(offset))
+
+        half = length // 2
+        split = bisect.bisect_left(indices, offset + half)
+        left = self._make_mountain_node(pos, offset, half, indices[:split],
+                                        need_length=split < len(indices))
+        right = self._make_mountain_node(pos + 2*half - 1, offset + half, half, indices[split:])
+        return proofmarshal.proof.VarProof.__new__(inner_cls, left=left, right=right, length=length)
+
+    def prove(self, indices):
+        """Create a proof of the values at indices
+
+        Returns an instance of mmr_class with the nodes leading to those values
+        unpruned, and everything else pruned.
+        """
+        n = len(self)
+        wanted = set()
+        for idx in indices:
+            if idx < 0:
+                idx += n
+            if not (0 <= idx < n):
+                raise IndexError('index out of range')
+            wanted.add(idx)
+        wanted = sorted(wanted)
+
+        if not self._peaks:
+            return self.mmr_class.EmptyNodeClass()
+
+        elif not wanted:
+            root_cls = self.mmr_class.LeafNodeClass if n == 1 else self.mmr_class.InnerNodeClass
+            return root_cls.from_data_hash(self.data_hash)
+
+        inner_cls = self.mmr_class.InnerNodeClass
+        new_node = proofmarshal.proof.VarProof.__new__
+
+        # Folds to the left of the first peak we're proving anything about are
+        # pruned, leaving just the length of the last such fold.
+        offset = 0
+        for first_wanted_peak, (length, peak_hash) in enumerate(self._peaks):
+            offset += length
+            if wanted[0] < offset:
+                break
+
+        folds = list(self._fold_peaks())
+        r = None
+        r_length = 0
+        pos = 0
+        for i, (length, peak_hash) in enumerate(self._peaks):
+            lo = bisect.bisect_left(wanted, r_length)
+            hi = bisect.bisect_left(wanted, r_length + length)
+            peak = self._make_mountain_node(pos, r_length, length, wanted[lo:hi],
+                                            need_length=(i == 0 and first_wanted_peak == 1))
+
+            if r is None:
+                r = peak
+
+            elif i < first_wanted_peak - 1:
+                r = inner_cls.from_data_hash(folds[i][0])
+
+            else:
+                r = new_node(inner_cls, left=r, right=peak, length=r_length + length)
+
+            pos += 2*length - 1
+            r_length += length
+
+        return r
+
+    def to_mmr(self):
+        """Create an unpruned instance of mmr_class"""
+        return self.prove(range(len(self)))
+
+class FileMerkleMountainRange(CompactMerkleMountainRange):
+    """Append-only, file-backed, merkle mountain range
+
+    Nodes are stored in post-order in the file at path, as fixed-size records
+    of the node's data hash followed by the length of the values file at that
+    point as a little-endian uint64. Values are stored serialized in the
+    values file, path + '.values'. Both files are only ever appended to, and
+    read through mmap.
+
+    On open only the O(log n) peaks are read. Incomplete appends left behind
+    by a crash are discarded.
+    """
+
+    RECORD = struct.Struct('<32sQ')
+
+    def __init__(self, mmr_class, path, iterable=()):
+        self.path = path
+        super().__init__(mmr_class, iterable)
+
+    def _open(self):
+        self._nodes_fd = open(self.path, 'a+b', buffering=0)
+        self._values_fd = open(self.path + '.values', 'a+b', buffering=0)
+        self._nodes_map = b''
+        self._values_map = b''
+
+        self._recover()
+
+    @staticmethod
+    def _write_all(fd, buf):
+        """Write all of buf to an unbuffered file, which may write less"""
+        buf = memoryview(buf)
+        while buf:
+            buf = buf[fd.write(buf):]
+
+    @staticmethod
+    def _mountains(num_nodes):
+        """Find the lengths of the mountains in an MMR with num_nodes nodes
+
+        Returns None if no MMR has that many nodes.
+        """
+        lengths = []
+        while num_nodes:
+            # Largest mountain that fits; mountains of length l have 2l-1 nodes
+            length = 1 << ((num_nodes + 1).bit_length() - 2)
+            if lengths and length >= lengths[-1]:
+                return None
+            lengths.append(length)
+            num_nodes -= 2*length - 1
+        return lengths
+
+    def _recover(self):
+        num_nodes = os.fstat(self._nodes_fd.fileno()).st_size // self.RECORD.size
+
+        # A crash part way through an append may leave a partial record, or a
+        # leaf without the inner nodes it should have been merged into. Either
+        # way we roll back to the last complete append; as no append adds more
+        # than 64 nodes we don't have to look far.
+        lengths = self._mountains(num_nodes)
+        while lengths is None:
+            num_nodes -= 1
+            lengths = self._mountains(num_nodes)
+
+        self._nodes_fd.truncate(num_nodes * self.RECORD.size)
+        self._num_nodes = num_nodes
+
+        self._values_end = self._record_at(num_nodes - 1)[1] if num_nodes else 0
+        self._values_fd.truncate(self._values_end)
+
+        self._peaks = []
+        pos = -1
+        for length in lengths:
+            pos += 2*length - 1
+            cls = self.mmr_class.LeafNodeClass if length == 1 else self.mmr_class.InnerNodeClass
+            self._peaks.append((length, cls.HASHTAG(self._data_hash_at(pos)).digest()))
+
+        self._num_values = sum(lengths)
+
+    def _record_at(self, pos):
+        start = pos * self.RECORD.size
+        end = start + self.RECORD.size
+        if end > len(self._nodes_map):
+            self._nodes_map = proofmarshal.serialize.mmap_file(self._nodes_fd)
+        return self.RECORD.unpack_from(self._nodes_map, start)
+
+    def _data_hash_at(self, pos):
+        return self._record_at(pos)[0]
+
+    def _value_at(self, idx):
+        # The leaf of the idx'th value is at position 2*idx - popcount(idx)
+        pos = 2*idx - bin(idx).count('1')
+        start = self._record_at(pos - 1)[1] if pos else 0
+        end = self._record_at(pos)[1]
+
+        if end > len(self._values_map):
+            self._values_map = proofmarshal.serialize.mmap_file(self._values_fd)
+        return self.mmr_class.VALUE_SERIALIZER.deserialize(self._values_map[start:end])
+
+    def _store(self, value, data_hashes):
+        serialized_value = self.mmr_class.VALUE_SERIALIZER.serialize(value)
+
+        self._write_all(self._values_fd, serialized_value)
+        self._values_end += len(serialized_value)
+
+        # All records are written at once, making a partial append less likely.
+        self._write_all(self._nodes_fd, b''.join(self.RECORD.pack(data_hash, self._values_end)
+                                                 for data_hash in data_hashes))
+
+        self._num_nodes += len(data_hashes)
+        self._num_values += 1
+
+    def __len__(self):
+        return self._num_values
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self._value_at(idx)
+
+    def sync(self):
+        """Flush appended data to disk"""
+        os.fsync(self._values_fd.fileno())
+        os.fsync(self._nodes_fd.fileno())
+
+    def close(self):
+        self._nodes_map = b''
+        self._values_map = b''
+        self._nodes_fd.close()
+        self._values_fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class MerkleMountainRangeAccumulator:
+    """Accumulate the commitment to a merkle mountain range
+
+    Only the O(log n) mountain peaks are kept, giving the same hash as the
+    equivalent mmr_class instance in constant memory. to_mmr() hands off to a
+    mmr_class instance that can be appended to, and proven, from then on.
+    """
+
+    def __init__(self, mmr_class, iterable=()):
+        self.mmr_class = mmr_class
+        self.length = 0
+
+        # (length, data_hash, hash, children) of every peak, left to right.
+        # children is the data hashes of the left and right children of the
+        # peak, or None for leaves.
+        self._peaks = []
+
+        self.extend(iterable)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value):
+        """Append a value"""
+        inner_hashtag = self.mmr_class.InnerNodeClass.HASHTAG
+
+        data_hash = _leaf_data_hash(self.mmr_class, value)
+        node_hash = self.mmr_class.LeafNodeClass.HASHTAG(data_hash).digest()
+        children = None
+
+        length = 1
+        while self._peaks and self._peaks[-1][0] == length:
+            left_length, left_data_hash, left_hash, left_children = self._peaks.pop()
+            length *= 2
+            children = (left_data_hash, data_hash)
+            data_hash = _inner_data_hash(left_hash, node_hash, length)
+            node_hash = inner_hashtag(data_hash).digest()
+
+        self._peaks.append((length, data_hash, node_hash, children))
+        self.length += 1
+
+    def extend(self, values):
+        """Append values from an iterable"""
+        for value in values:
+            self.append(value)
+
+    def _fold_peaks(self):
+        return _fold_peaks(self.mmr_class, [(length, peak_hash) for length, data_hash, peak_hash, children in self._peaks])
+
+    @property
+    def data_hash(self):
+        if not self._peaks:
+            return self.mmr_class.EmptyNodeClass().data_hash
+
+        elif len(self._peaks) == 1:
+            return self._peaks[0][1]
+
+        else:
+            for data_hash, fold_hash in self._fold_peaks():
+                pass
+            return data_hash
+
+    @property
+    def hash(self):
+        if not self._peaks:
+            return self.mmr_class.EmptyNodeClass().hash
+
+        for data_hash, fold_hash in self._fold_peaks():
+            pass
+        return fold_hash
+
+    def to_mmr(self):
+        """Create a pruned instance of mmr_class
+
+        The peaks are pruned, leaving only their lengths, so the result can be
+        appended to.
+        """
+        leaf_cls = self.mmr_class.LeafNodeClass
+        inner_cls = self.mmr_class.InnerNodeClass
+        new_node = proofmarshal.proof.VarProof.__new__
+
+        r = None
+        r_length = 0
+        for length, data_hash, peak_hash, children in self._peaks:
+            if children is None:
+                peak = leaf_cls.from_data_hash(data_hash)
+
+            else:
+                child_cls = leaf_cls if length == 2 else inner_cls
+                peak = new_node(inner_cls, left=child_cls.from_data_hash(children[0]),
+                                           right=child_cls.from_data_hash(children[1]),
+                                           length=length)
+
+            r_length += length
+            if r is None:
+                r = peak
+            else:
+                r = new_node(inner_cls, left=r, right=peak, length=r_length)
+
+        if r is None:
+            r = self.mmr_class.EmptyNodeClass()
+
+        return r
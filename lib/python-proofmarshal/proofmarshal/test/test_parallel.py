@@ -0,0 +1,87 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import hashlib
+import multiprocessing
+import unittest
+
+from proofmarshal.proof import VarProof
+from proofmarshal.parallel import parallel_hash, _is_hashed, _partition
+from proofmarshal.test.test_mmr import IntMMR
+from proofmarshal.test.test_merbinnertree import IntMBTree
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+class Test_parallel_hash(unittest.TestCase):
+    def test_mmr(self):
+        for n in (0, 1, 2, 3, 100, 1000):
+            expected_hash = IntMMR(range(n)).hash
+
+            mmr = IntMMR(range(n))
+            self.assertEqual(parallel_hash(mmr, max_workers=2), expected_hash)
+
+            self.assertTrue(_is_hashed(mmr))
+
+            # Nodes within the subtrees the workers hashed are hashed again
+            # on demand, with the same results.
+            expected_leaf_hashes = [leaf.hash for leaf in IntMMR(range(n))._iter_leaves()]
+            self.assertEqual([leaf.hash for leaf in mmr._iter_leaves()], expected_leaf_hashes)
+
+    def test_partition(self):
+        mmr = IntMMR(range(1000))
+        top, subtrees = _partition(mmr, 8)
+        self.assertEqual(len(subtrees), 8)
+        self.assertIs(top[0], mmr)
+
+        # Only the roots of the subtrees, and the top nodes, are hashed in
+        # this process.
+        parallel_hash(mmr, max_workers=2)
+        self.assertTrue(all(_is_hashed(node) for node in top + subtrees))
+        self.assertFalse(any(_is_hashed(node.left) for node in subtrees))
+
+    def test_partially_hashed(self):
+        mmr = IntMMR(range(500))
+        mmr.hash
+
+        mmr = mmr.extend(range(500, 1000))
+        self.assertEqual(parallel_hash(mmr, max_workers=3), IntMMR(range(1000)).hash)
+
+    def test_pruned(self):
+        mmr = IntMMR(range(100))
+        proof = mmr.prove([10, 20, 30])
+        self.assertEqual(parallel_hash(proof, max_workers=2), mmr.hash)
+
+    def test_shared_nodes(self):
+        def make_tree():
+            Inner = IntMMR.InnerNodeClass
+            t = IntMMR(range(64))
+            u = VarProof.__new__(Inner, left=t, right=t, length=128)
+            v = VarProof.__new__(Inner, left=u, right=t.left, length=160)
+            return VarProof.__new__(Inner, left=v, right=u, length=288)
+
+        expected_hash = make_tree().hash
+        for max_workers in (2, 3, 4):
+            tree = make_tree()
+            self.assertEqual(parallel_hash(tree, max_workers=max_workers), expected_hash)
+
+    def test_merbinnertree(self):
+        items = [(hashlib.sha256(bytes([i])).digest(), i) for i in range(200)]
+
+        expected = IntMBTree()
+        tree = IntMBTree()
+        for key, value in items:
+            expected = expected.put(key, value)
+            tree = tree.put(key, value)
+
+        self.assertEqual(parallel_hash(tree, max_workers=4), expected.hash)
+
+    def test_serial_fallback(self):
+        mmr = IntMMR(range(100))
+        self.assertEqual(parallel_hash(mmr, max_workers=1), IntMMR(range(100)).hash)
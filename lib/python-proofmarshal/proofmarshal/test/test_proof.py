@@ -11,6 +11,8 @@
 
 import hashlib
 import hmac
+import os
+import tempfile
 import unittest
 
 from proofmarshal.proof import *
@@ -52,6 +54,17 @@ class Test_Proof(unittest.TestCase):
         self.assertNotEqual(hash(f1a), hash(f2))
         self.assertEqual(len(set([f1a, f1b, f2])), 2)
 
+    def test_checkinstance(self):
+        """Proof attributes must be instances of their Proof class"""
+        FooProof.check_instance(FooProof(n=1))
+
+        for bad_value in (None, 1, BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)):
+            with self.assertRaises(SerializerTypeError):
+                FooProof.check_instance(bad_value)
+
+            with self.assertRaises(SerializerTypeError):
+                BarProof(left=FooProof(n=1), right=bad_value, nonproof_attr=3)
+
     def test_pruning(self):
         """Proof pruning"""
 
@@ -175,6 +188,21 @@ class Test_Proof(unittest.TestCase):
 
         self.assertEqual(b.nonproof_attr, 3)
 
+    def test_serialized_size(self):
+        """Proof.serialized_size()"""
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        self.assertEqual(b.serialized_size(), len(b.serialize()))
+        self.assertEqual(b._Proof__serialized_size, len(b.serialize()))
+
+        # Pruned proofs change size as they're unpruned, so sizes aren't cached.
+        pruned_b = b.prune()
+        self.assertEqual(pruned_b.serialized_size(), 33)
+        pruned_b.left.n
+        self.assertEqual(pruned_b.serialized_size(), len(pruned_b.serialize()))
+
+        foo_or_bar = ProofUnion(FooProof, BarProof)
+        self.assertEqual(foo_or_bar.serialized_size(b), len(foo_or_bar.serialize(b)))
+
     def test_PrunedError(self):
         """PrunedError raised when pruned attribute is not available"""
 
@@ -260,6 +288,15 @@ class Test_VarProof(unittest.TestCase):
         expected_inner_hash = H(InnerFooVarProof, expected_empty_hash + expected_leaf_hash)
         self.assertEqual(inner.hash, expected_inner_hash)
 
+    def test_variant_subclass_serialization(self):
+        """Subclasses of variants serialize as the variant they inherit from"""
+        class SubLeafFooVarProof(LeafFooVarProof):
+            pass
+
+        x = SubLeafFooVarProof(value=0xf)
+        FooVarProof.check_instance(x)
+        self.assertEqual(x.serialize(), LeafFooVarProof(value=0xf).serialize())
+
     def test_hmac_derivation(self):
         self.assertNotEqual(FooVarProof.HASHTAG, DerivedHmacFooVarProof.HASHTAG)
         self.assertEqual(DerivedHmacFooVarProof.HASHTAG,
@@ -312,3 +349,201 @@ class Test_ProofUnion(unittest.TestCase):
 
         self.assertEqual(self.Foo_or_Bar.get_hash(f1), f1.hash)
         self.assertEqual(self.Foo_or_Bar.get_hash(b1), b1.hash)
+
+class Test_MemoizedSerialization(unittest.TestCase):
+    def roundtrip(self, value, serialization_class):
+        ctx = MemoizedBufferSerializationContext()
+        ctx.write_obj(value, serialization_class)
+        serialized = ctx.getbytes()
+
+        ctx = MemoizedBufferDeserializationContext(serialized)
+        return (serialized, ctx.read_obj(serialization_class))
+
+    def test_shared_objects(self):
+        """Shared objects are written once, and deserialized as one instance"""
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=1), nonproof_attr=3)
+
+        serialized, b2 = self.roundtrip(b, BarProof)
+        self.assertEqual(serialized,
+                         (b'\x01' + b'\x00' + # memoized, not pruned
+                          b'\x01' + b'\x00\x01' + # left memoized
+                          b'\x02' + # right refers back to left
+                          b'\x03'))
+
+        self.assertEqual(b2, b)
+        self.assertIs(b2.left, b2.right)
+
+    def test_pruned_objects(self):
+        """Pruned objects aren't confused with unpruned objects"""
+        f = FooProof(n=1)
+        b = BarProof(left=f.prune(), right=f, nonproof_attr=3)
+
+        serialized, b2 = self.roundtrip(b, BarProof)
+        self.assertEqual(b2, b)
+        self.assertTrue(b2.left.is_fully_pruned)
+        self.assertFalse(b2.right.is_pruned)
+
+        # Partially pruned objects are written inline
+        pruned_b = b.prune()
+        pruned_b.nonproof_attr
+        serialized, b2 = self.roundtrip(pruned_b, BarProof)
+        self.assertEqual(serialized[0], 0)
+        self.assertEqual(b2, b)
+
+    def test_bad_back_references(self):
+        """Invalid back-references are rejected"""
+        with self.assertRaises(DeserializationError):
+            MemoizedBufferDeserializationContext(b'\x00\x00\x02\x02\x03').read_obj(BarProof)
+
+        # Back-reference to an object of the wrong type
+        class BazProof(Proof):
+            HASHTAG = HashTag('d1f0b38d-3dc3-4d0e-9b8e-4d5c7b5e0f5a')
+            SERIALIZED_ATTRS = [('bar', BarProof),
+                                ('foo', FooProof)]
+
+        serialized_bar = (b'\x01\x00' +
+                          b'\x01\x00\x01' + # memo[0]
+                          b'\x01\x00\x02' + # memo[1]
+                          b'\x03') # memo[2]
+
+        baz = MemoizedBufferDeserializationContext(b'\x00\x00' + serialized_bar + b'\x03').read_obj(BazProof)
+        self.assertIs(baz.foo, baz.bar.right)
+
+        with self.assertRaises(DeserializationError):
+            MemoizedBufferDeserializationContext(b'\x00\x00' + serialized_bar + b'\x04').read_obj(BazProof)
+
+class Test_LazyDeserialization(unittest.TestCase):
+    def test_lazy_deserialization(self):
+        """Lazy deserialization only deserializes attributes as they are used"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        serialized_bar = bar.serialize()
+
+        lazy_bar = BarProof.lazy_deserialize(serialized_bar)
+        self.assertFalse(lazy_bar.is_pruned)
+        self.assertFalse(hasattr(lazy_bar, '_Proof__serialized_size'))
+        with self.assertRaises(AttributeError):
+            object.__getattribute__(lazy_bar, 'left')
+
+        # Getting an attribute after a proof only skips over the proof.
+        self.assertEqual(lazy_bar.nonproof_attr, 3)
+        with self.assertRaises(AttributeError):
+            object.__getattribute__(lazy_bar.left, 'n')
+
+        self.assertEqual(lazy_bar.sum(), 3)
+        self.assertEqual(lazy_bar.hash, bar.hash)
+        self.assertEqual(lazy_bar.serialize(), serialized_bar)
+
+    def test_lazy_pruned_deserialization(self):
+        """Lazy deserialization of pruned proofs"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        pruned_bar = bar.prune()
+        pruned_bar.right.n
+        serialized_pruned_bar = pruned_bar.serialize()
+
+        lazy_bar = BarProof.lazy_deserialize(serialized_pruned_bar)
+        self.assertTrue(lazy_bar.is_pruned)
+        self.assertFalse(lazy_bar.is_fully_pruned)
+        self.assertEqual(lazy_bar.right.n, 2)
+        self.assertTrue(lazy_bar.left.is_fully_pruned)
+        with self.assertRaises(PrunedError):
+            lazy_bar.left.n
+        self.assertEqual(lazy_bar.hash, bar.hash)
+        self.assertEqual(lazy_bar.serialize(), serialized_pruned_bar)
+
+        lazy_bar = BarProof.lazy_deserialize(bar.prune().serialize())
+        self.assertTrue(lazy_bar.is_fully_pruned)
+        self.assertEqual(lazy_bar.hash, bar.hash)
+
+    def test_lazy_union_deserialization(self):
+        """Lazy deserialization of VarProofs and ProofUnions"""
+        inner = InnerFooVarProof(left=LeafFooVarProof(value=1), right=EmptyFooVarProof())
+        lazy_inner = FooVarProof.lazy_deserialize(inner.serialize())
+        self.assertIs(lazy_inner.__class__, InnerFooVarProof)
+        self.assertIs(lazy_inner.right.__class__, EmptyFooVarProof)
+        self.assertEqual(lazy_inner.left.value, 1)
+        self.assertEqual(lazy_inner.hash, inner.hash)
+
+        foo_or_bar = ProofUnion(FooProof, BarProof)
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        lazy_bar = foo_or_bar.lazy_deserialize(foo_or_bar.serialize(bar))
+        self.assertIs(lazy_bar.__class__, BarProof)
+        self.assertEqual(lazy_bar.sum(), 3)
+
+    def test_lazy_truncated(self):
+        """Errors in lazily deserialized data are raised on access"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        lazy_bar = BarProof.lazy_deserialize(bar.serialize()[:-1])
+        self.assertEqual(lazy_bar.left.n, 1)
+        with self.assertRaises(TruncationError):
+            lazy_bar.nonproof_attr
+
+    def test_mmap_deserialize(self):
+        """Deserialization from memory-mapped files"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        foo_or_bar = ProofUnion(FooProof, BarProof)
+
+        with tempfile.TemporaryFile() as fd:
+            fd.write(bar.serialize())
+            fd.flush()
+
+            mmap_bar = BarProof.mmap_deserialize(fd)
+            self.assertEqual(mmap_bar.sum(), 3)
+            self.assertEqual(mmap_bar.hash, bar.hash)
+
+        with tempfile.TemporaryFile() as fd:
+            fd.write(foo_or_bar.serialize(bar))
+            fd.flush()
+
+            mmap_bar = foo_or_bar.mmap_deserialize(fd.fileno())
+            self.assertEqual(mmap_bar.hash, bar.hash)
+
+        with tempfile.TemporaryFile() as fd:
+            with self.assertRaises(TruncationError):
+                BarProof.mmap_deserialize(fd)
+
+    def test_mmap_deserialize_pipe(self):
+        """Deserialization from pipes, which can't be memory-mapped"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+
+        for as_file_object in (True, False):
+            r, w = os.pipe()
+            os.write(w, bar.serialize())
+            os.close(w)
+
+            if as_file_object:
+                with os.fdopen(r, 'rb') as fd:
+                    pipe_bar = BarProof.mmap_deserialize(fd)
+            else:
+                try:
+                    pipe_bar = BarProof.mmap_deserialize(r)
+                finally:
+                    os.close(r)
+
+            self.assertEqual(pipe_bar.sum(), 3)
+            self.assertEqual(pipe_bar.hash, bar.hash)
+
+class Test_PushDeserializer(unittest.TestCase):
+    def test_proofs(self):
+        """Incremental deserialization of proofs"""
+        bar = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        pruned_bar = bar.prune()
+        pruned_bar.left.n
+        inner = InnerFooVarProof(left=LeafFooVarProof(value=1), right=EmptyFooVarProof())
+        foo_or_bar = ProofUnion(FooProof, BarProof)
+
+        def T(serialization_class, value):
+            serialized = serialization_class.serialize(value) * 2
+
+            d = PushDeserializer(serialization_class)
+            values = []
+            for b in serialized:
+                values.extend(d.feed(bytes([b])))
+
+            self.assertEqual(values, [value, value])
+            self.assertEqual(values[0].serialize(), value.serialize())
+
+        T(BarProof, bar)
+        T(BarProof, pruned_bar)
+        T(BarProof, bar.prune())
+        T(FooVarProof, inner)
+        T(foo_or_bar, bar)
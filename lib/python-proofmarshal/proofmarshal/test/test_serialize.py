@@ -9,8 +9,10 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import asyncio
 import hashlib
 import hmac
+import pickle
 import unittest
 
 from proofmarshal.serialize import *
@@ -136,3 +138,211 @@ class Test_VarBytes(unittest.TestCase):
             VarBytes(2,3).deserialize(b'\x02a')
         with self.assertRaises(DeserializationError):
             VarBytes(2,3).deserialize(b'\x02')
+
+class Test_BufferDeserializationContext(unittest.TestCase):
+    def test_read_varuint(self):
+        """BufferDeserializationContext.read_varuint()"""
+        def T(buf, expected_value):
+            for buf_type in (bytes, bytearray):
+                ctx = BufferDeserializationContext(buf_type(buf))
+                self.assertEqual(ctx.read_varuint(), expected_value)
+                self.assertEqual(ctx.pos, len(buf))
+
+        T(b'\x00', 0)
+        T(b'\x7f', 0x7f)
+        T(b'\x80\x01', 0x80)
+        T(b'\xff\x7f', 0x3fff)
+        T(b'\x80\x80\x01', 0x4000)
+
+        with self.assertRaises(TruncationError):
+            BufferDeserializationContext(b'').read_varuint()
+        with self.assertRaises(TruncationError):
+            BufferDeserializationContext(b'\x80').read_varuint()
+
+    def test_read_bytes(self):
+        """BufferDeserializationContext.read_bytes()"""
+        for buf_type in (bytes, bytearray):
+            ctx = BufferDeserializationContext(buf_type(b'abcd'))
+            self.assertEqual(ctx.read_bytes(1), b'a')
+            self.assertIs(ctx.read_bytes(2).__class__, bytes)
+            with self.assertRaises(TruncationError):
+                ctx.read_bytes(2)
+
+    def test_read_bytes_view(self):
+        """BufferDeserializationContext.read_bytes_view() doesn't copy"""
+        buf = bytearray(b'abcd')
+        ctx = BufferDeserializationContext(buf)
+        ctx.read_bytes(1)
+        view = ctx.read_bytes_view(2)
+        self.assertEqual(view, b'bc')
+
+        buf[1] = ord('B')
+        self.assertEqual(view, b'Bc')
+
+    def test_read_bool(self):
+        """BufferDeserializationContext.read_bool()"""
+        ctx = BufferDeserializationContext(b'\xff\x00\x01')
+        self.assertIs(ctx.read_bool(), True)
+        self.assertIs(ctx.read_bool(), False)
+        with self.assertRaises(DeserializationError):
+            ctx.read_bool()
+        with self.assertRaises(TruncationError):
+            ctx.read_bool()
+
+class Test_BufferSerializationContext(unittest.TestCase):
+    def test_write_varuint(self):
+        """BufferSerializationContext.write_varuint()"""
+        def T(value, expected_serialized):
+            ctx = BufferSerializationContext()
+            ctx.write_varuint(value)
+            self.assertEqual(ctx.getbytes(), expected_serialized)
+
+            self.assertEqual(encode_varuint(value), expected_serialized)
+
+            ctx = BufferDeserializationContext(expected_serialized)
+            self.assertEqual(ctx.read_varuint(), value)
+
+        T(0, b'\x00')
+        T(0x7f, b'\x7f')
+        T(0x80, b'\x80\x01')
+        T(0x3fff, b'\xff\x7f')
+        T(0x4000, b'\x80\x80\x01')
+        T(2**64-1, b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\x01')
+
+    def test_append_to_existing_buffer(self):
+        """BufferSerializationContext appends to an existing bytearray"""
+        buf = bytearray(b'abc')
+        ctx = BufferSerializationContext(buf)
+        ctx.write_bool(True)
+        ctx.write_bytes(b'def')
+        self.assertEqual(buf, b'abc\xffdef')
+
+    def test_getbuffer(self):
+        """BufferSerializationContext.getbuffer()"""
+        ctx = BufferSerializationContext()
+        ctx.write_bytes(b'abc')
+        with ctx.getbuffer() as view:
+            self.assertEqual(view, b'abc')
+            self.assertIs(view.obj, ctx.buf)
+
+        # Can be written to again once the view is released
+        ctx.write_bool(False)
+        self.assertEqual(ctx.getbytes(), b'abc\x00')
+
+class Test_HashingSerializationContext(unittest.TestCase):
+    def test_matches_serialized_bytes(self):
+        """HashingSerializationContext hashes exactly the serialized bytes"""
+        ctx = HashingSerializationContext()
+        VarBytes(16).ctx_serialize(b'abc', ctx)
+        UInt64.ctx_serialize(2**40, ctx)
+        SerBool.ctx_serialize(True, ctx)
+
+        expected = (VarBytes(16).serialize(b'abc') +
+                    UInt64.serialize(2**40) +
+                    SerBool.serialize(True))
+        self.assertEqual(ctx.digest(), hashlib.sha256(expected).digest())
+
+    def test_hasher(self):
+        """HashingSerializationContext with a supplied hasher"""
+        tag = HashTag('b5b59d51-cb5b-4a6c-8d9e-3a9bd8e2a1a6')
+        ctx = HashingSerializationContext(tag())
+        ctx.write_varuint(300)
+        self.assertEqual(ctx.digest(), tag(encode_varuint(300)).digest())
+
+class Test_SizeSerializationContext(unittest.TestCase):
+    def test_serialized_size(self):
+        """Serializer.serialized_size() matches len(serialize())"""
+        def T(serialization_class, value):
+            self.assertEqual(serialization_class.serialized_size(value),
+                             len(serialization_class.serialize(value)))
+
+        T(SerBool, True)
+        T(FixedBytes(3), b'abc')
+        T(VarBytes(300), b'')
+        T(VarBytes(300), b'a'*200)
+        for i in (0, 0x7f, 0x80, 0x3fff, 0x4000, 2**63, 2**64-1):
+            T(UInt64, i)
+            self.assertEqual(varuint_size(i), len(encode_varuint(i)))
+
+class Test_PushDeserializer(unittest.TestCase):
+    def test_feed(self):
+        """Values are deserialized as bytes are fed"""
+        d = PushDeserializer(VarBytes(1000))
+        self.assertEqual(d.feed(b''), [])
+        self.assertEqual(d.feed(b'\x03a'), [])
+        self.assertEqual(d.feed(b'b'), [])
+        self.assertEqual(d.feed(b'c\x00\x01'), [b'abc', b''])
+        self.assertEqual(d.feed(b'd'), [b'd'])
+        self.assertEqual(d.buf, b'')
+
+    def test_max_bytes(self):
+        """Values larger than max_bytes are rejected"""
+        d = PushDeserializer(VarBytes(1000), max_bytes=4)
+        self.assertEqual(d.feed(b'\x03abc'), [b'abc'])
+        self.assertEqual(d.feed(b'\x04'), [])
+        with self.assertRaises(DeserializationError):
+            d.feed(b'abcd')
+
+        d = PushDeserializer(VarBytes(1000), max_bytes=4)
+        self.assertEqual(d.feed(b'\x10abc'), [])
+        with self.assertRaises(DeserializationError):
+            d.feed(b'd')
+
+    def test_read(self):
+        """Values are read from asyncio streams"""
+        async def read_all(chunks):
+            reader = asyncio.StreamReader()
+            for chunk in chunks:
+                reader.feed_data(chunk)
+            reader.feed_eof()
+
+            d = PushDeserializer(UInt64)
+            r = []
+            try:
+                while True:
+                    r.append(await d.read(reader))
+            except TruncationError:
+                return (r, bytes(d.buf))
+
+        self.assertEqual(asyncio.run(read_all([])), ([], b''))
+        self.assertEqual(asyncio.run(read_all([b'\x01\x80', b'\x01'])), ([1, 0x80], b''))
+        self.assertEqual(asyncio.run(read_all([b'\x01\x80'])), ([1], b'\x80'))
+
+class Test_HashTag(unittest.TestCase):
+    def test_call(self):
+        """Tagged hashing"""
+        tag = HashTag('0b4a2c4b-b2b2-4d1d-a16e-cd10e0fcb20d')
+        self.assertEqual(tag(b'').digest(), hashlib.sha256(tag).digest())
+        self.assertEqual(tag(b'foo').digest(), hashlib.sha256(tag + b'foo').digest())
+
+        # Returned hashers are independent
+        h = tag(b'foo')
+        h.update(b'bar')
+        self.assertEqual(tag(b'foo').digest(), hashlib.sha256(tag + b'foo').digest())
+
+    def test_hash_many(self):
+        """Hashing multiple messages at once"""
+        tag = HashTag('0b4a2c4b-b2b2-4d1d-a16e-cd10e0fcb20d')
+        msgs = [b'', b'foo', b'bar'*100]
+        self.assertEqual(tag.hash_many(msgs), [tag(msg).digest() for msg in msgs])
+        self.assertEqual(tag.hash_many(iter(msgs)), [tag(msg).digest() for msg in msgs])
+        self.assertEqual(tag.hash_many([]), [])
+
+    def test_derive(self):
+        """Tag derivation"""
+        tag = HashTag('0b4a2c4b-b2b2-4d1d-a16e-cd10e0fcb20d')
+        subtag = HashTag('2f8a7d4e-1a84-4f4c-a4c5-e6b4e3b1a6b9')
+
+        derived_tag = tag.derive(subtag)
+        derivation_tag = HashTag('8125d227-981c-4ca0-afa7-ab9911352c85')
+        self.assertEqual(derived_tag, hashlib.sha256(derivation_tag + tag + subtag).digest()[0:16])
+        self.assertEqual(derived_tag(b'foo').digest(), hashlib.sha256(derived_tag + b'foo').digest())
+
+    def test_pickle(self):
+        """Tags can be pickled"""
+        tag = HashTag('0b4a2c4b-b2b2-4d1d-a16e-cd10e0fcb20d')
+        derived_tag = tag.derive(tag)
+        for t in (tag, derived_tag):
+            t2 = pickle.loads(pickle.dumps(t))
+            self.assertEqual(t2, t)
+            self.assertEqual(t2(b'foo').digest(), t(b'foo').digest())
@@ -12,8 +12,9 @@
 import proofmarshal.bits
 
 from proofchains.core.uniquebits.singleuseseal import FakeSingleUseSeal, FakeSealWitness
+from proofmarshal.merbinnertree import PrefixCache, cached_prefix_property
 from proofmarshal.proof import VarProof, ProofUnion
-from proofmarshal.serialize import HashTag
+from proofmarshal.serialize import HashTag, HashingSerializationContext
 
 class GuMap(VarProof):
     """Globally Unique Map"""
@@ -24,6 +25,9 @@ class GuMap(VarProof):
     KEY_SERIALIZER = None
     VALUE_SERIALIZER = None
 
+    # How many recently used keys to cache the prefixes of; see PrefixCache
+    PREFIX_CACHE_SIZE = 65536
+
     @staticmethod
     def key2prefix(key):
         return key.hash
@@ -33,6 +37,8 @@ class GuMap(VarProof):
 
 
 def make_GuMap_subclass(subclass):
+    subclass._key2prefix = PrefixCache.for_class(subclass, GuMap.key2prefix)
+
     @subclass.declare_variant
     class UnusedPrefix(subclass):
         """A prefix whose seal hasn't been used yet"""
@@ -52,7 +58,9 @@ def make_GuMap_subclass(subclass):
     class LeafPrefix(subclass):
         """A prefix whose seal has been closed over a key:value pair"""
 
-        __slots__ = ('key','value')
+        # The prefix is cached, but isn't serialized, so never affects the
+        # hash.
+        __slots__ = ('key','value','__prefix')
         SERIALIZED_ATTRS = [('witness', ProofUnion(FakeSealWitness, subclass.WITNESS_CLASS)),
                             ('key', subclass.KEY_SERIALIZER),
                             ('value', subclass.VALUE_SERIALIZER)]
@@ -67,9 +75,7 @@ def make_GuMap_subclass(subclass):
             return proofmarshal.proof.VarProof.__new__(cls, witness=witness, key=key, value=value)
 
 
-        @property
-        def prefix(self):
-            return self.key2prefix(self.key)
+        prefix = cached_prefix_property('_LeafPrefix__prefix')
 
         @property
         def seal(self):
@@ -80,27 +86,23 @@ def make_GuMap_subclass(subclass):
             # FIXME: this is kinda dodgy... should define some kind of
             # "canonical hash representation" in the proofmarshal serialization
             # stuff. What's the right term for this?
+            ctx = HashingSerializationContext(cls.CONTENTS_HASHTAG())
             try:
-                key_hash = cls.KEY_SERIALIZER.get_hash(key)
-            except AttributeError:
-                key_hash = cls.KEY_SERIALIZER.serialize(key)
-
-            try:
-                value_hash = cls.VALUE_SERIALIZER.get_hash(value)
+                ctx.write_bytes(cls.KEY_SERIALIZER.get_hash(key))
             except AttributeError:
-                value_hash = cls.VALUE_SERIALIZER.serialize(value)
+                cls.KEY_SERIALIZER.ctx_serialize(key, ctx)
 
             try:
-                cls.CONTENTS_HASHTAG
+                ctx.write_bytes(cls.VALUE_SERIALIZER.get_hash(value))
             except AttributeError:
-                cls.CONTENTS_HASHTAG = HashTag('59c17f37-7e26-4aea-8a5b-7c0db66af35b').derive(cls.HASHTAG)
+                cls.VALUE_SERIALIZER.ctx_serialize(value, ctx)
 
-            msg = key_hash + value_hash
-            return cls.CONTENTS_HASHTAG(msg).digest()
+            return ctx.digest()
 
         def verify(self):
             self.witness.verify_hash(self.__calc_sealed_hash(self.key, self.value))
 
+    LeafPrefix.CONTENTS_HASHTAG = HashTag('59c17f37-7e26-4aea-8a5b-7c0db66af35b').derive(LeafPrefix.HASHTAG)
     subclass.LeafPrefix = LeafPrefix
 
 
@@ -142,16 +144,12 @@ def make_GuMap_subclass(subclass):
 
         @classmethod
         def __calc_sealed_hash(cls, left, right):
-            try:
-                cls.CONTENTS_HASHTAG
-            except AttributeError:
-                cls.CONTENTS_HASHTAG = HashTag('b925044d-320e-4c1f-9ef8-20614d260676').derive(cls.HASHTAG)
-
             msg = left.seal.hash + right.seal.hash
             return cls.CONTENTS_HASHTAG(msg).digest()
 
         def verify(self):
             self.witness.verify_hash(self.__calc_sealed_hash(self.left, self.right))
+    InnerPrefix.CONTENTS_HASHTAG = HashTag('b925044d-320e-4c1f-9ef8-20614d260676').derive(InnerPrefix.HASHTAG)
     subclass.InnerPrefix = InnerPrefix
 
     return subclass
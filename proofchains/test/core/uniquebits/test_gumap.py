@@ -82,6 +82,18 @@ class Test_GuMap(unittest.TestCase):
 
         inner_prefix.verify()
 
+    def test_LeafPrefix_prefix(self):
+        """LeafPrefix.prefix"""
+        unused_prefix = IntGuMap.UnusedPrefix(prefix=Bits(), seal=make_btc_seal())
+        leaf_prefix = IntGuMap.LeafPrefix.from_unused_prefix(unused_prefix, 5, 0, make_btc_witness)
+
+        self.assertEqual(leaf_prefix.prefix, Bits.from_bytes(b'\x00\x00\x00\x05'))
+
+        # Computed once, and doesn't affect the hash
+        self.assertIs(leaf_prefix.prefix, leaf_prefix.prefix)
+        self.assertEqual(leaf_prefix.hash,
+                         IntGuMap.LeafPrefix.deserialize(leaf_prefix.serialize()).hash)
+
     def test_fakeseal_trick(self):
         """GuMap's using fake seals"""
         up0 = IntGuMap.UnusedPrefix(prefix=Bits([0]), seal=make_btc_seal())
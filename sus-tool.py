@@ -205,7 +205,7 @@ verifywitness_parser.add_argument('-l','--local',
         help="Only verify local self-consistency; don't attempt to determine if the witness tx is in the chain")
 
 def cmd_verifywitness(args):
-    witness = BitcoinSealWitness.deserialize(args.witness_fd.read())
+    witness = BitcoinSealWitness.mmap_deserialize(args.witness_fd)
 
     # FIXME: implement --local
     witness.verify()
@@ -240,7 +240,7 @@ witnessinfo_parser.add_argument('witness_fd', metavar='WITNESS-FILE',
         help='Witness file')
 
 def cmd_witnessinfo(args):
-    witness = BitcoinSealWitness.deserialize(args.witness_fd.read())
+    witness = BitcoinSealWitness.mmap_deserialize(args.witness_fd)
 
     print('Hash:\t\t%s' % b2x(witness.hash))
     print('Txid:\t\t%s' % b2lx(witness.txinproof.txproof.txhash))